@@ -21,16 +21,20 @@ indended to be used with existing build systems such as autotools.
 """
 import argparse
 import atexit
-from distutils.dir_util import copy_tree
+import concurrent.futures
+import functools
 import inspect
+import io
 import logging
-import platform
 import os
 import shutil
 import stat
+import subprocess
 import sys
+import tarfile
 import tempfile
 import textwrap
+import time
 
 
 THIS_DIR = os.path.realpath(os.path.dirname(__file__))
@@ -56,28 +60,168 @@ def check_ndk_or_die():
             sys.exit('Failed sanity check: missing {}'.format(check_path))
 
 
+# Buffer size for file data copies. shutil's default (64 KiB) needs far more
+# read/write syscalls than necessary for the multi-megabyte toolchain
+# binaries.
+COPY_BUFSIZE = 1024 * 1024
+
+# Destination directories already created by the tree copy helpers, kept
+# across calls so overlaying several trees onto one install directory only
+# pays for each mkdir once. Mirrors the cache distutils.dir_util kept for
+# mkpath.
+_seen_dirs = set()
+
+
+def copy_tree_threaded(src, dst):
+    """Copies a directory tree using a pool of worker threads.
+
+    The toolchain trees are tens of thousands of small files, so the copy is
+    dominated by per-file syscall latency rather than throughput. Issuing the
+    copies from a thread pool keeps many I/O requests in flight at once.
+    """
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        _copy_dir_entries(src, dst, executor, _seen_dirs, futures)
+    # Surface the first failed copy; an ENOSPC or unreadable source must
+    # fail the script rather than produce a silently incomplete toolchain.
+    for future in futures:
+        future.result()
+
+
+def _copy_file_data(fsrc, fdst, size):
+    """Copies file contents between two open files.
+
+    Uses os.sendfile where available to move the data in the kernel rather
+    than bouncing each buffer through userspace. The Windows copies go
+    through robocopy, which already uses CopyFileEx internally.
+    """
+    if hasattr(os, 'sendfile'):
+        try:
+            infd = fsrc.fileno()
+            outfd = fdst.fileno()
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(outfd, infd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError:
+            # Not all file systems support sendfile; fall back to a
+            # buffered copy.
+            fsrc.seek(0)
+    shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+
+
+def _copy_file_entry(entry, dst_path):
+    """Copies a regular file, reusing the stat info cached on the DirEntry.
+
+    shutil.copy2 would stat the source again to recover the mode and
+    timestamps, but os.scandir already fetched them when it read the
+    directory, so copy the data and apply the cached metadata directly.
+    """
+    st = entry.stat()
+    with open(entry.path, 'rb') as fsrc:
+        with open(dst_path, 'wb') as fdst:
+            _copy_file_data(fsrc, fdst, st.st_size)
+    os.chmod(dst_path, stat.S_IMODE(st.st_mode))
+    os.utime(dst_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _copy_dir_entries(src, dst, executor, seendirs, futures):
+    """Recursively submits file copies for a directory to an executor.
+
+    seendirs tracks destination directories known to exist so that copying
+    several source trees into the same install directory does not repeat
+    the isdir/mkdir syscalls for directories created by an earlier pass.
+    Submitted futures are appended to futures so the caller can check them
+    for copy errors.
+    """
+    if dst not in seendirs:
+        os.makedirs(dst, exist_ok=True)
+        seendirs.add(dst)
+    for entry in os.scandir(src):
+        dst_path = os.path.join(dst, entry.name)
+        if entry.is_symlink():
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            os.symlink(os.readlink(entry.path), dst_path)
+        elif entry.is_dir():
+            _copy_dir_entries(entry.path, dst_path, executor, seendirs,
+                              futures)
+        else:
+            futures.append(executor.submit(_copy_file_entry, entry, dst_path))
+
+
+def copy_tree(src, dst):
+    """Copies a directory tree into a destination that may already exist.
+
+    Prefers the platform's native bulk copy tool, which is far faster than a
+    file-at-a-time Python copy for the large toolchain trees this script
+    installs. robocopy copies with many threads, and cp can use reflinks on
+    file systems that support them, eliminating most of the data writes.
+    """
+    if os.name == 'nt':
+        result = subprocess.run(
+            ['robocopy', src, dst, '/MT:64', '/E', '/NDL', '/NFL', '/NJH',
+             '/NJS'])
+        # robocopy exits 0 when there was nothing to copy and 1 when files
+        # were copied; higher codes report mismatched, extra, or failed
+        # files, none of which should happen copying into the install
+        # directory.
+        if result.returncode > 1:
+            sys.exit('Failed to copy {} to {}'.format(src, dst))
+        return
+
+    os.makedirs(dst, exist_ok=True)
+    src_dot = os.path.join(src, '.')
+    if sys.platform == 'darwin':
+        # On APFS, -c clones the files via clonefile rather than copying
+        # their data. cp fails outright on file systems that cannot clone,
+        # so fall through to the plain copy in that case.
+        result = subprocess.run(['cp', '-Rpc', src_dot, dst])
+        if result.returncode == 0:
+            return
+    args = ['cp', '-a']
+    if sys.platform.startswith('linux'):
+        # Btrfs and XFS reflink rather than copy data with this flag; other
+        # file systems degrade to a normal copy.
+        args.append('--reflink=auto')
+    args.extend([src_dot, dst])
+    result = subprocess.run(args)
+    if result.returncode != 0:
+        logger().info('Native copy failed, falling back to threaded copy')
+        copy_tree_threaded(src, dst)
+
+
+TRIPLES = {
+    'arm': 'arm-linux-androideabi',
+    'arm64': 'aarch64-linux-android',
+    'x86': 'i686-linux-android',
+    'x86_64': 'x86_64-linux-android',
+}
+
+
+@functools.lru_cache(maxsize=None)
 def get_triple(arch):
     """Return the triple for the given architecture."""
-    return {
-        'arm': 'arm-linux-androideabi',
-        'arm64': 'aarch64-linux-android',
-        'x86': 'i686-linux-android',
-        'x86_64': 'x86_64-linux-android',
-    }[arch]
+    return TRIPLES[arch]
 
 
+@functools.lru_cache(maxsize=None)
 def get_host_tag_or_die():
     """Return the host tag for this platform. Die if not supported."""
-    if platform.system() == 'Linux':
+    if sys.platform.startswith('linux'):
         return 'linux-x86_64'
-    elif platform.system() == 'Darwin':
+    elif sys.platform == 'darwin':
         return 'darwin-x86_64'
-    elif platform.system() == 'Windows':
+    elif sys.platform == 'win32':
         host_tag = 'windows-x86_64'
         if not os.path.exists(os.path.join(NDK_DIR, 'prebuilt', host_tag)):
             host_tag = 'windows'
         return host_tag
-    sys.exit('Unsupported platform: ' + platform.system())
+    sys.exit('Unsupported platform: ' + sys.platform)
 
 
 def get_toolchain_path_or_die():
@@ -88,34 +232,92 @@ def get_toolchain_path_or_die():
     return toolchain_path
 
 
-def make_clang_scripts(install_dir, triple, api, windows):
-    """Creates Clang wrapper scripts.
+# Wrapper script templates, dedented once at import time rather than every
+# time a script is rendered. {pp} is '++' for the C++ wrappers and empty for
+# the C wrappers.
+CLANG_SCRIPT_TEMPLATE = textwrap.dedent("""\
+    #!/bin/bash
+    if [ "$1" != "-cc1" ]; then
+        `dirname $0`/clang{version}{pp} {flags} "$@"
+    else
+        # target/triple already spelled out.
+        `dirname $0`/clang{version}{pp} "$@"
+    fi
+""")
+
+CLANG_BAT_TEMPLATE = textwrap.dedent("""\
+    @echo off
+    setlocal
+    call :find_bin
+    if "%1" == "-cc1" goto :L
+
+    set "_BIN_DIR=" && %_BIN_DIR%{exe} {flags} %*
+    if ERRORLEVEL 1 exit /b 1
+    goto :done
+
+    :L
+    rem target/triple already spelled out.
+    set "_BIN_DIR=" && %_BIN_DIR%{exe} %*
+    if ERRORLEVEL 1 exit /b 1
+    goto :done
+
+    :find_bin
+    rem Accommodate a quoted arg0, e.g.: "clang"
+    rem https://github.com/android-ndk/ndk/issues/616
+    set _BIN_DIR=%~dp0
+    exit /b
+
+    :done
+""")
+
+
+def write_script(path, text):
+    """Writes a pre-rendered script to disk in one shot.
+
+    The text is encoded up front and handed to a single binary write, rather
+    than going through the text layer's buffering and newline translation.
+    Batch files still get CRLF endings: cmd.exe's label scanning is
+    unreliable with LF-only files.
+    """
+    if path.endswith('.cmd'):
+        text = text.replace('\n', '\r\n')
+    with open(path, 'wb') as script:
+        script.write(text.encode('utf-8'))
 
-    The Clang in standalone toolchains historically was designed to be used as
-    a drop-in replacement for GCC for better compatibility with existing
-    projects. Since a large number of projects are not set up for cross
-    compiling (and those that are expect the GCC style), our Clang should
-    already know what target it is building for.
 
-    Create wrapper scripts that invoke Clang with `-target` and `--sysroot`
-    preset.
+def link_or_copy(src, dst):
+    """Hardlinks a file into place, falling back to a copy.
+
+    The wrapper duplicates all live inside the install directory, so they are
+    normally on one file system and a hard link costs no data writes. Fall
+    back to a real copy for file systems that refuse links.
     """
-    with open(os.path.join(install_dir, 'AndroidVersion.txt')) as version_file:
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def get_clang_version_number(toolchain_dir):
+    """Returns the major+minor Clang version string, e.g. '70'."""
+    version_path = os.path.join(toolchain_dir, 'AndroidVersion.txt')
+    with open(version_path) as version_file:
         major, minor, _build = version_file.read().strip().split('.')
+    return major + minor
 
-    version_number = major + minor
 
-    exe = ''
-    if windows:
-        exe = '.exe'
+def render_clang_wrappers(version_number, triple, api, windows):
+    """Renders the contents of the Clang wrapper scripts.
 
-    bin_dir = os.path.join(install_dir, 'bin')
-    shutil.move(os.path.join(bin_dir, 'clang' + exe),
-                os.path.join(bin_dir, 'clang{}'.format(version_number) + exe))
-    shutil.move(os.path.join(bin_dir, 'clang++' + exe),
-                os.path.join(bin_dir, 'clang{}++'.format(
-                    version_number) + exe))
+    Rendering needs nothing from the install directory, so the caller can do
+    it while the toolchain tree is still being copied; only installing the
+    scripts has to wait for the copy to finish.
 
+    Returns:
+        A dict mapping script names (relative to bin/) to script text.
+    """
     arch, os_name, env = triple.split('-')
     if arch == 'arm':
         arch = 'armv7a'  # Target armv7, not armv5.
@@ -130,104 +332,178 @@ def make_clang_scripts(install_dir, triple, api, windows):
     if arch == 'i686' and api < 24:
         flags += ' -mstackrealign'
 
-    clang_path = os.path.join(install_dir, 'bin/clang')
-    with open(clang_path, 'w') as clang:
-        clang.write(textwrap.dedent("""\
-            #!/bin/bash
-            if [ "$1" != "-cc1" ]; then
-                `dirname $0`/clang{version} {flags} "$@"
-            else
-                # target/triple already spelled out.
-                `dirname $0`/clang{version} "$@"
-            fi
-        """.format(version=version_number, flags=flags)))
-
-    mode = os.stat(clang_path).st_mode
-    os.chmod(clang_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-
-    clangpp_path = os.path.join(install_dir, 'bin/clang++')
-    with open(clangpp_path, 'w') as clangpp:
-        clangpp.write(textwrap.dedent("""\
-            #!/bin/bash
-            if [ "$1" != "-cc1" ]; then
-                `dirname $0`/clang{version}++ {flags} "$@"
-            else
-                # target/triple already spelled out.
-                `dirname $0`/clang{version}++ "$@"
-            fi
-        """.format(version=version_number, flags=flags)))
-
-    mode = os.stat(clangpp_path).st_mode
-    os.chmod(clangpp_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-
-    shutil.copy2(os.path.join(install_dir, 'bin/clang'),
-                 os.path.join(install_dir, 'bin', triple + '-clang'))
-    shutil.copy2(os.path.join(install_dir, 'bin/clang++'),
-                 os.path.join(install_dir, 'bin', triple + '-clang++'))
+    scripts = {
+        'clang': CLANG_SCRIPT_TEMPLATE.format(
+            version=version_number, pp='', flags=flags),
+        'clang++': CLANG_SCRIPT_TEMPLATE.format(
+            version=version_number, pp='++', flags=flags),
+    }
 
     if windows:
         for pp_suffix in ('', '++'):
             exe_name = 'clang{}{}.exe'.format(version_number, pp_suffix)
-            clangbat_text = textwrap.dedent("""\
-                @echo off
-                setlocal
-                call :find_bin
-                if "%1" == "-cc1" goto :L
-
-                set "_BIN_DIR=" && %_BIN_DIR%{exe} {flags} %*
-                if ERRORLEVEL 1 exit /b 1
-                goto :done
-
-                :L
-                rem target/triple already spelled out.
-                set "_BIN_DIR=" && %_BIN_DIR%{exe} %*
-                if ERRORLEVEL 1 exit /b 1
-                goto :done
-
-                :find_bin
-                rem Accommodate a quoted arg0, e.g.: "clang"
-                rem https://github.com/android-ndk/ndk/issues/616
-                set _BIN_DIR=%~dp0
-                exit /b
-
-                :done
-            """.format(exe=exe_name, flags=flags))
-
+            clangbat_text = CLANG_BAT_TEMPLATE.format(exe=exe_name, flags=flags)
             for triple_prefix in ('', triple + '-'):
-                clangbat_path = os.path.join(
-                    install_dir, 'bin',
-                    '{}clang{}.cmd'.format(triple_prefix, pp_suffix))
-                with open(clangbat_path, 'w') as clangbat:
-                    clangbat.write(clangbat_text)
+                name = '{}clang{}.cmd'.format(triple_prefix, pp_suffix)
+                scripts[name] = clangbat_text
+    return scripts
+
+
+def make_clang_scripts(install_dir, version_number, triple, scripts, windows):
+    """Installs pre-rendered Clang wrapper scripts.
+
+    The Clang in standalone toolchains historically was designed to be used as
+    a drop-in replacement for GCC for better compatibility with existing
+    projects. Since a large number of projects are not set up for cross
+    compiling (and those that are expect the GCC style), our Clang should
+    already know what target it is building for.
+
+    Install wrapper scripts that invoke Clang with `-target` and `--sysroot`
+    preset. The script contents come from render_clang_wrappers.
+    """
+    exe = ''
+    if windows:
+        exe = '.exe'
+
+    bin_dir = os.path.join(install_dir, 'bin')
+    shutil.move(os.path.join(bin_dir, 'clang' + exe),
+                os.path.join(bin_dir, 'clang{}'.format(version_number) + exe))
+    shutil.move(os.path.join(bin_dir, 'clang++' + exe),
+                os.path.join(bin_dir, 'clang{}++'.format(
+                    version_number) + exe))
+
+    for name, text in scripts.items():
+        script_path = os.path.join(bin_dir, name)
+        write_script(script_path, text)
+        if not name.endswith('.cmd'):
+            # The scripts were just created with the default file mode, so
+            # there are no meaningful bits to preserve; set the final mode
+            # directly rather than fetching it back with stat first.
+            os.chmod(script_path, 0o755)
+
+    link_or_copy(os.path.join(bin_dir, 'clang'),
+                 os.path.join(bin_dir, triple + '-clang'))
+    link_or_copy(os.path.join(bin_dir, 'clang++'),
+                 os.path.join(bin_dir, triple + '-clang++'))
 
 
 def replace_gcc_wrappers(install_path, triple, is_windows):
     cmd = '.cmd' if is_windows else ''
+    bin_dir = os.path.join(install_path, 'bin')
 
-    gcc = os.path.join(install_path, 'bin', triple + '-gcc' + cmd)
-    clang = os.path.join(install_path, 'bin', 'clang' + cmd)
-    shutil.copy2(clang, gcc)
-
-    gpp = os.path.join(install_path, 'bin', triple + '-g++' + cmd)
-    clangpp = os.path.join(install_path, 'bin', 'clang++' + cmd)
-    shutil.copy2(clangpp, gpp)
+    link_or_copy(os.path.join(bin_dir, 'clang' + cmd),
+                 os.path.join(bin_dir, triple + '-gcc' + cmd))
+    link_or_copy(os.path.join(bin_dir, 'clang++' + cmd),
+                 os.path.join(bin_dir, triple + '-g++' + cmd))
 
 
 def create_toolchain(install_path, arch, api, toolchain_path, host_tag):
     """Create a standalone toolchain."""
-    copy_tree(toolchain_path, install_path)
     triple = get_triple(arch)
-    make_clang_scripts(
-        install_path, triple, api, host_tag.startswith('windows'))
-    replace_gcc_wrappers(install_path, triple, host_tag.startswith('windows'))
-
     prebuilt_path = os.path.join(NDK_DIR, 'prebuilt', host_tag)
-    copy_tree(prebuilt_path, install_path)
-
     gdbserver_path = os.path.join(
         NDK_DIR, 'prebuilt', 'android-' + arch, 'gdbserver')
     gdbserver_install = os.path.join(install_path, 'share', 'gdbserver')
-    shutil.copytree(gdbserver_path, gdbserver_install)
+
+    # The three tree copies write to disjoint sets of files, so run them
+    # concurrently. The wrapper scripts are rendered while the copies run;
+    # only installing them has to wait for the toolchain copy, since that
+    # step renames and replaces binaries the copy installs.
+    is_windows = host_tag.startswith('windows')
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        toolchain_copy = executor.submit(
+            copy_tree, toolchain_path, install_path)
+        other_copies = [
+            executor.submit(copy_tree, prebuilt_path, install_path),
+            executor.submit(copy_tree, gdbserver_path, gdbserver_install),
+        ]
+        version_number = get_clang_version_number(toolchain_path)
+        scripts = render_clang_wrappers(version_number, triple, api,
+                                        is_windows)
+        toolchain_copy.result()
+        make_clang_scripts(
+            install_path, version_number, triple, scripts, is_windows)
+        replace_gcc_wrappers(install_path, triple, is_windows)
+        for copy in other_copies:
+            copy.result()
+
+
+def make_package(package_basename, install_path, windows):
+    """Packages the install tree as an archive next to package_basename.
+
+    Windows gets a zip; everything else gets a bzip2 tarball written with
+    tarfile directly so the tar stream uses 1 MiB records instead of
+    shutil.make_archive's default 10 KiB blocks.
+    """
+    os.makedirs(os.path.dirname(package_basename), exist_ok=True)
+    root_dir = os.path.dirname(install_path)
+    base_dir = os.path.basename(install_path)
+    if windows:
+        shutil.make_archive(
+            package_basename, 'zip', root_dir=root_dir, base_dir=base_dir)
+        return
+
+    with tarfile.open(package_basename + '.tar.bz2', 'w:bz2',
+                      bufsize=COPY_BUFSIZE) as tar:
+        tar.add(install_path, arcname=base_dir)
+
+
+def stream_package(package_basename, arch, api, toolchain_path, host_tag):
+    """Streams the packaged toolchain straight from the NDK install.
+
+    Packaging mode used to copy the whole toolchain into a temporary
+    directory only for tar to read every byte back out again. Instead, write
+    the tar stream directly from the source trees, applying the clang
+    renames and wrapper scripts as tar entries along the way. This replaces
+    create_toolchain plus make_package on non-Windows hosts.
+    """
+    triple = get_triple(arch)
+    version_number = get_clang_version_number(toolchain_path)
+    scripts = render_clang_wrappers(version_number, triple, api, False)
+    # The triple-prefixed wrappers and the gcc/g++ replacements are the same
+    # scripts under other names.
+    scripts[triple + '-clang'] = scripts['clang']
+    scripts[triple + '-clang++'] = scripts['clang++']
+    scripts[triple + '-gcc'] = scripts['clang']
+    scripts[triple + '-g++'] = scripts['clang++']
+
+    renames = {
+        'bin/clang': 'bin/clang' + version_number,
+        'bin/clang++': 'bin/clang' + version_number + '++',
+    }
+    replaced = frozenset('bin/' + name for name in scripts)
+
+    def toolchain_filter(tarinfo):
+        rel = tarinfo.name[len(triple) + 1:]
+        # The renames must be applied before the replacement check: the
+        # clang binary moves out of bin/clang so the wrapper script can take
+        # its name.
+        new_name = renames.get(rel)
+        if new_name is not None:
+            tarinfo.name = triple + '/' + new_name
+        elif rel in replaced:
+            return None
+        return tarinfo
+
+    prebuilt_path = os.path.join(NDK_DIR, 'prebuilt', host_tag)
+    gdbserver_path = os.path.join(
+        NDK_DIR, 'prebuilt', 'android-' + arch, 'gdbserver')
+
+    os.makedirs(os.path.dirname(package_basename), exist_ok=True)
+    mtime = time.time()
+    with tarfile.open(package_basename + '.tar.bz2', 'w:bz2',
+                      bufsize=COPY_BUFSIZE) as tar:
+        tar.add(toolchain_path, arcname=triple, filter=toolchain_filter)
+        tar.add(prebuilt_path, arcname=triple)
+        tar.add(gdbserver_path,
+                arcname='/'.join([triple, 'share', 'gdbserver']))
+        for name, text in sorted(scripts.items()):
+            data = text.encode('utf-8')
+            script_info = tarfile.TarInfo(triple + '/bin/' + name)
+            script_info.size = len(data)
+            script_info.mode = 0o755
+            script_info.mtime = mtime
+            tar.addfile(script_info, io.BytesIO(data))
 
 
 def warn_unnecessary(is_windows):
@@ -344,24 +620,22 @@ def main():
                 shutil.rmtree(install_path)
             else:
                 sys.exit('Installation directory already exists. Use --force.')
-    else:
+        create_toolchain(install_path, args.arch, api, toolchain_path,
+                         host_tag)
+    elif host_tag.startswith('windows'):
         tempdir = tempfile.mkdtemp()
         atexit.register(shutil.rmtree, tempdir)
         install_path = os.path.join(tempdir, triple)
-
-    create_toolchain(install_path, args.arch, api, toolchain_path, host_tag)
-
-    if args.install_dir is None:
-        if host_tag.startswith('windows'):
-            package_format = 'zip'
-        else:
-            package_format = 'bztar'
-
+        create_toolchain(install_path, args.arch, api, toolchain_path,
+                         host_tag)
         package_basename = os.path.join(args.package_dir, triple)
-        shutil.make_archive(
-            package_basename, package_format,
-            root_dir=os.path.dirname(install_path),
-            base_dir=os.path.basename(install_path))
+        make_package(package_basename, install_path, True)
+    else:
+        # Tarball packaging can stream straight out of the NDK install
+        # without materializing the toolchain on disk first.
+        package_basename = os.path.join(args.package_dir, triple)
+        stream_package(package_basename, args.arch, api, toolchain_path,
+                       host_tag)
 
 
 if __name__ == '__main__':
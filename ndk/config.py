@@ -1,6 +1,3 @@
-from __future__ import print_function
-
-
 major = 20
 hotfix = 0
 hotfix_str = chr(ord('a') + hotfix) if hotfix else ''
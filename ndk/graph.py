@@ -31,8 +31,8 @@ class Node(object):
     def __repr__(self):
         return self.name
 
-    def __cmp__(self, other):
-        return cmp(self.name, other.name)
+    def __lt__(self, other):
+        return self.name < other.name
 
 
 class Graph(object):
@@ -62,10 +62,11 @@ class Graph(object):
     def find_cycle_from_node(self, node, visited, path=None):
         """Finds a cycle from a given node if there is one.
 
-        Performs a recursive depth-first search to see if there are any cycles
-        in a connected component. The caller of this method should ensure that
-        the first node searched is a source node if there is one, as this
-        method will not backtrack to find cycles prior to the given node.
+        Performs an iterative depth-first search to see if there are any
+        cycles in a connected component. The caller of this method should
+        ensure that the first node searched is a source node if there is one,
+        as this method will not backtrack to find cycles prior to the given
+        node.
 
         If there is no source node in the connected component, there is
         certainly a cycle in the component, but this method can still be used
@@ -85,18 +86,32 @@ class Graph(object):
         if path is None:
             path = []
 
+        # An explicit stack of out-edge iterators stands in for the call
+        # stack, so deep dependency chains cannot hit the recursion limit.
+        # The iterator on top of the stack belongs to the node on the end of
+        # the path.
         path.append(node)
         if node in path[:-1]:
             return path[path.index(node):]
-
         if node in visited:
             path.pop()
             return None
-
         visited.add(node)
-        for in_node in node.outs:
-            cycle = self.find_cycle_from_node(in_node, visited, path)
-            if cycle is not None:
-                return cycle
-        path.pop()
+
+        stack = [iter(node.outs)]
+        while stack:
+            out_node = next(stack[-1], None)
+            if out_node is None:
+                stack.pop()
+                path.pop()
+                continue
+
+            path.append(out_node)
+            if out_node in path[:-1]:
+                return path[path.index(out_node):]
+            if out_node in visited:
+                path.pop()
+                continue
+            visited.add(out_node)
+            stack.append(iter(out_node.outs))
         return None
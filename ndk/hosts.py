@@ -16,6 +16,7 @@
 """Constants and helper functions for NDK hosts."""
 from __future__ import absolute_import
 
+import functools
 import os
 import sys
 
@@ -28,7 +29,11 @@ ALL_HOSTS = (
 )
 
 
+@functools.lru_cache(maxsize=None)
 def get_host_tag(ndk_path):
+    # The tag is a pure function of the platform and (on Windows) the NDK's
+    # prebuilt layout, so cache it rather than re-probing the directory for
+    # every tool lookup.
     if sys.platform.startswith('linux'):
         return 'linux-x86_64'
     elif sys.platform == 'darwin':
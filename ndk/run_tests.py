@@ -20,34 +20,28 @@ from __future__ import print_function
 
 import argparse
 import collections
+import concurrent.futures
+import functools
 import json
 import logging
 import multiprocessing
 import os
+import itertools
 import posixpath
-import random
 import site
+import socket
+import struct
 import subprocess
 import sys
 import time
 import traceback
 
-import ndk.ansi
 import ndk.ext.subprocess
-import ndk.notify
 import ndk.paths
-import ndk.test.builder
 import ndk.test.config
-import ndk.test.devices
-import ndk.test.filters
-import ndk.test.printers
-import ndk.test.report
 import ndk.test.result
 import ndk.test.spec
-import ndk.test.types
-import ndk.test.ui
 import ndk.timer
-import ndk.ui
 import ndk.workqueue
 
 
@@ -59,12 +53,156 @@ def logger():
     return logging.getLogger(__name__)
 
 
+class PersistentShell(object):
+    """A long-lived `adb shell` session for running many commands.
+
+    Every device.shell_nocheck call pays the full adb connect and shell spawn
+    round-trip, which dominates the cost of running thousands of small test
+    binaries. Feeding commands to a single persistent shell over stdin
+    amortizes that overhead across every test run on the device. Command
+    outputs are split with a sentinel that also carries the exit status.
+    """
+
+    END_MARKER = '__NDK_COMMAND_DONE__'
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.process = None
+        # Set when the device's shell echoes input back at us (legacy
+        # devices without the shell_v2 protocol get a PTY with echo on).
+        # Such a session can't distinguish the echoed sentinel from the real
+        # one, so the device is permanently routed to one-shot shells.
+        self.broken = False
+
+    READY_MARKER = '__NDK_SHELL_READY__'
+
+    def start(self):
+        self.process = subprocess.Popen(
+            ['adb', '-s', self.serial, 'shell'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        # Turn off echo in case the device handed us a PTY (legacy shells
+        # without shell_v2 do); harmless where it did not. Draining up to
+        # the ready marker also discards the echo of this setup line itself,
+        # since only the real marker line consists of the marker alone.
+        self.process.stdin.write(
+            'stty -echo 2>/dev/null; echo {}\n'.format(
+                self.READY_MARKER).encode('utf-8'))
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                self.process = None
+                raise RuntimeError(
+                    'adb shell for {} exited during setup'.format(
+                        self.serial))
+            if line.decode('utf-8', 'replace').strip() == self.READY_MARKER:
+                break
+
+    def run(self, cmd):
+        """Runs a command in the persistent shell.
+
+        Returns:
+            A (status, stdout, stderr) tuple matching shell_nocheck. stderr
+            is always empty since the shell merges it into stdout.
+        """
+        if self.broken:
+            raise RuntimeError(
+                'adb shell for {} echoes input; persistent shell '
+                'disabled'.format(self.serial))
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        shell_input = '{}; echo {}$?\n'.format(cmd, self.END_MARKER)
+        self.process.stdin.write(shell_input.encode('utf-8'))
+        self.process.stdin.flush()
+
+        out_lines = []
+        while True:
+            line = self.process.stdout.readline().decode('utf-8', 'replace')
+            if not line:
+                self.process = None
+                raise RuntimeError(
+                    'adb shell for {} exited unexpectedly'.format(
+                        self.serial))
+            line = line.replace('\r\n', '\n')
+            # If the command's output didn't end with a newline the sentinel
+            # shares a line with the output's tail, so look for it anywhere
+            # in the line and keep whatever preceded it.
+            marker_idx = line.find(self.END_MARKER)
+            if marker_idx != -1:
+                status_text = line[marker_idx + len(self.END_MARKER):].strip()
+                try:
+                    status = int(status_text)
+                except ValueError:
+                    # A literal '$?' (or other junk) after the marker means
+                    # the shell echoed our own input back, so everything we
+                    # read from this session is suspect. Shut it down and
+                    # let the caller fall back to one-shot shells.
+                    self.broken = True
+                    self.process.kill()
+                    self.process = None
+                    raise RuntimeError(
+                        'adb shell for {} echoed the sentinel (got {!r}); '
+                        'persistent shell disabled'.format(
+                            self.serial, status_text))
+                if marker_idx > 0:
+                    out_lines.append(line[:marker_idx])
+                return status, ''.join(out_lines), ''
+            out_lines.append(line)
+
+
+# Persistent shells keyed by device serial. Worker processes each get their
+# own copy of this module, so every worker keeps one shell per device it
+# talks to. The subprocess handle cannot be pickled, which is why the cache
+# lives here rather than on the Device object sent to the worker.
+_persistent_shells = {}
+
+
+def get_persistent_shell(device):
+    """Returns the persistent shell for a device, creating it on first use."""
+    shell = _persistent_shells.get(device.serial)
+    if shell is None:
+        shell = PersistentShell(device.serial)
+        _persistent_shells[device.serial] = shell
+    return shell
+
+
 def shell_nocheck_wrap_errors(device, cmd):
-    """Invokes device.shell_nocheck and wraps exceptions as failed commands."""
+    """Runs a shell command on a device and wraps exceptions as failures.
+
+    Commands go through the device's persistent shell session when possible,
+    falling back to a one-shot device.shell_nocheck if the session dies
+    during the handshake.
+    """
+    try:
+        return get_persistent_shell(device).run(cmd)
+    except (OSError, RuntimeError):
+        pass
     try:
-        return device.shell_nocheck(cmd)
+        return device.shell_nocheck([cmd])
     except RuntimeError as ex:
-        return 1, traceback.format_exc(ex), ''
+        # format_exc takes a traceback depth limit, not an exception, and
+        # formatting the whole stack reads source files for every frame.
+        # The exception message is all the report needs.
+        return 1, ''.join(
+            traceback.format_exception_only(type(ex), ex)), ''
+
+
+@functools.lru_cache(maxsize=None)
+def get_device_test_config(test_dir):
+    """Loads a device test config, caching by test directory.
+
+    Many test cases share a test directory (and thus a test_config.py), so
+    loading the config once per directory rather than once per check avoids
+    re-executing the same config module thousands of times.
+    """
+    return ndk.test.config.DeviceTestConfig.from_test_dir(test_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def get_libcxx_test_config(test_dir):
+    """Loads a libc++ test config, caching by test directory."""
+    return ndk.test.config.LibcxxTestConfig.from_test_dir(test_dir)
 
 
 # TODO: Extract a common interface from this and ndk.test.types.Test for the
@@ -77,12 +215,32 @@ class TestCase(object):
     will have a name, a build configuration, a build system, and a device
     directory.
     """
+    __slots__ = ('name', 'test_src_dir', 'config', 'build_system',
+                 'device_dir', '_test_config')
+
     def __init__(self, name, test_src_dir, config, build_system, device_dir):
         self.name = name
         self.test_src_dir = test_src_dir
         self.config = config
         self.build_system = build_system
         self.device_dir = device_dir
+        self._test_config = None
+
+    def __getstate__(self):
+        # The cached config holds a loaded module, which can't be pickled, so
+        # drop it when the test case is shipped to a worker process. The
+        # worker reloads it on first use.
+        state = {
+            slot: getattr(self, slot)
+            for klass in type(self).__mro__
+            for slot in getattr(klass, '__slots__', ())
+        }
+        state['_test_config'] = None
+        return state
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
 
     def check_unsupported(self, device):
         raise NotImplementedError
@@ -90,6 +248,16 @@ class TestCase(object):
     def check_broken(self, device):
         raise NotImplementedError
 
+    def has_broken_rules(self):
+        """Returns True if the test's config defines any run_broken rules.
+
+        Most test directories have no test_config.py (or one with no
+        run_broken), so callers can skip the per-device broken check
+        entirely for them.
+        """
+        config = self.get_test_config()
+        return config.run_broken is not type(config).NullTestConfig.run_broken
+
     def run(self, device):
         raise NotImplementedError
 
@@ -102,21 +270,27 @@ class BasicTestCase(TestCase):
     $TEST_SUITE/$ABI/$TEST_FILES. $TEST_FILES includes both the shared
     libraries for the test and the test executables.
     """
+    __slots__ = ('suite', 'executable', 'cmd')
+
     def __init__(self, suite, executable, test_src_dir, config, build_system,
                  device_dir):
-        name = '.'.join([suite, executable])
+        name = f'{suite}.{executable}'
         super(BasicTestCase, self).__init__(
             name, test_src_dir, config, build_system, device_dir)
 
         self.suite = suite
         self.executable = executable
+        self.cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
+            device_dir, device_dir, executable)
 
     def get_test_config(self):
-        # We don't run anything in tests/build, and the libc++ tests are
-        # handled by a different LibcxxTest. We can safely assume that anything
-        # here is in tests/device.
-        test_dir = os.path.join(self.test_src_dir, 'device', self.suite)
-        return ndk.test.config.DeviceTestConfig.from_test_dir(test_dir)
+        if self._test_config is None:
+            # We don't run anything in tests/build, and the libc++ tests are
+            # handled by a different LibcxxTest. We can safely assume that
+            # anything here is in tests/device.
+            test_dir = os.path.join(self.test_src_dir, 'device', self.suite)
+            self._test_config = get_device_test_config(test_dir)
+        return self._test_config
 
     def check_unsupported(self, device):
         return self.get_test_config().run_unsupported(
@@ -132,10 +306,8 @@ class BasicTestCase(TestCase):
             message = 'test unsupported for {}'.format(config)
             return ndk.test.result.Skipped(self, message)
 
-        cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
-            self.device_dir, self.device_dir, self.executable)
-        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
-        return shell_nocheck_wrap_errors(device, [cmd])
+        logger().info('%s: shell_nocheck "%s"', device.name, self.cmd)
+        return shell_nocheck_wrap_errors(device, self.cmd)
 
 
 class LibcxxTestCase(TestCase):
@@ -147,6 +319,8 @@ class LibcxxTestCase(TestCase):
     directory and any under it may contain test executables (always suffixed
     with ".exe") or test data (always suffixed with ".dat").
     """
+    __slots__ = ('suite', 'executable', 'cmd')
+
     def __init__(self, suite, executable, test_src_dir, config, device_dir):
         # Tests in the top level don't need any mangling to match the filters.
         if suite == 'libc++':
@@ -156,17 +330,24 @@ class LibcxxTestCase(TestCase):
 
         # The executable name ends with .exe. Remove that so it matches the
         # filter that would be used to build the test.
-        name = '.'.join(['libc++', filter_name[:-4]])
+        name = f'libc++.{filter_name[:-4]}'
         super(LibcxxTestCase, self).__init__(
             name, test_src_dir, config, 'libc++', device_dir)
 
         self.suite = suite
         self.executable = executable
+        libcxx_so_dir = posixpath.join(
+            DEVICE_TEST_BASE_DIR, str(config), 'libcxx/libc++')
+        self.cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
+            device_dir, libcxx_so_dir, executable)
 
     def get_test_config(self):
-        _, _, test_subdir = self.suite.partition('/')
-        test_dir = os.path.join(self.test_src_dir, 'libc++/test', test_subdir)
-        return ndk.test.config.LibcxxTestConfig.from_test_dir(test_dir)
+        if self._test_config is None:
+            _, _, test_subdir = self.suite.partition('/')
+            test_dir = os.path.join(
+                self.test_src_dir, 'libc++/test', test_subdir)
+            self._test_config = get_libcxx_test_config(test_dir)
+        return self._test_config
 
     def check_unsupported(self, device):
         # Executable is foo.pass.cpp.exe, we want foo.pass.
@@ -187,16 +368,14 @@ class LibcxxTestCase(TestCase):
         return None, None
 
     def run(self, device):
-        libcxx_so_dir = posixpath.join(
-            DEVICE_TEST_BASE_DIR, str(self.config), 'libcxx/libc++')
-        cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
-            self.device_dir, libcxx_so_dir, self.executable)
-        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
-        return shell_nocheck_wrap_errors(device, [cmd])
+        logger().info('%s: shell_nocheck "%s"', device.name, self.cmd)
+        return shell_nocheck_wrap_errors(device, self.cmd)
 
 
 class TestRun(object):
     """A test case mapped to the device group it will run on."""
+    __slots__ = ('test_case', 'device_group')
+
     def __init__(self, test_case, device_group):
         self.test_case = test_case
         self.device_group = device_group
@@ -218,11 +397,13 @@ class TestRun(object):
         if status == 0:
             result = ndk.test.result.Success(self)
         else:
-            out = '\n'.join([str(device), out])
+            out = f'{device}\n{out}'
             result = ndk.test.result.Failure(self, out)
         return self.fixup_xfail(result, device)
 
     def fixup_xfail(self, result, device):
+        if not self.test_case.has_broken_rules():
+            return result
         config, bug = self.test_case.check_broken(device)
         if config is not None:
             if result.failed():
@@ -242,6 +423,11 @@ class TestRun(object):
 
 def build_tests(test_src_dir, ndk_dir, out_dir, clean, printer, config,
                 test_filter):
+    # Deferred since the builder pulls in most of the test framework. This
+    # has to be the first statement: a local import anywhere in the function
+    # makes 'ndk' function-local everywhere in it.
+    import ndk.test.builder
+
     test_options = ndk.test.spec.TestOptions(
         test_src_dir, ndk_dir, out_dir, test_filter=test_filter, clean=clean)
 
@@ -255,26 +441,29 @@ def enumerate_basic_tests(out_dir_base, test_src_dir, build_cfg, build_system,
                           test_filter):
     tests = []
     tests_dir = os.path.join(out_dir_base, str(build_cfg), build_system)
-    if not os.path.exists(tests_dir):
+    try:
+        test_subdirs = os.listdir(tests_dir)
+    except FileNotFoundError:
+        # Not all build systems are present in every configuration.
         return tests
 
-    for test_subdir in os.listdir(tests_dir):
+    for test_subdir in test_subdirs:
         test_dir = os.path.join(tests_dir, test_subdir)
         out_dir = os.path.join(test_dir, build_cfg.abi)
         test_relpath = os.path.relpath(out_dir, out_dir_base)
         device_dir = posixpath.join(
             DEVICE_TEST_BASE_DIR, ndk.paths.to_posix_path(test_relpath))
-        for test_file in os.listdir(out_dir):
-            if test_file.endswith('.so'):
-                continue
-            if test_file.endswith('.sh'):
-                continue
-            name = '.'.join([test_subdir, test_file])
-            if not test_filter.filter(name):
-                continue
-            tests.append(BasicTestCase(
-                test_subdir, test_file, test_src_dir, build_cfg, build_system,
-                device_dir))
+        with os.scandir(out_dir) as it:
+            for test_entry in it:
+                test_file = test_entry.name
+                if test_file.endswith(('.so', '.sh')):
+                    continue
+                name = f'{test_subdir}.{test_file}'
+                if not test_filter.filter(name):
+                    continue
+                tests.append(BasicTestCase(
+                    test_subdir, test_file, test_src_dir, build_cfg,
+                    build_system, device_dir))
     return tests
 
 
@@ -282,42 +471,55 @@ def enumerate_libcxx_tests(out_dir_base, test_src_dir, build_cfg, build_system,
                            test_filter):
     tests = []
     tests_dir = os.path.join(out_dir_base, str(build_cfg), build_system)
-    if not os.path.exists(tests_dir):
-        return tests
 
-    for root, _, files in os.walk(tests_dir):
-        for test_file in files:
-            if not test_file.endswith('.exe'):
-                continue
-            test_relpath = os.path.relpath(root, out_dir_base)
-            device_dir = posixpath.join(
-                DEVICE_TEST_BASE_DIR, ndk.paths.to_posix_path(test_relpath))
-            suite_name = ndk.paths.to_posix_path(
-                os.path.relpath(root, tests_dir))
-
-            # Our file has a .exe extension, but the name should match the
-            # source file for the filters to work.
-            test_name = test_file[:-4]
-
-            # Tests in the top level don't need any mangling to match the
-            # filters.
-            if suite_name != 'libc++':
-                if not suite_name.startswith('libc++/'):
-                    raise ValueError(suite_name)
-                # According to the test runner, these are all part of the
-                # "libc++" test, and the rest of the data is the subtest name.
-                # i.e.  libc++/foo/bar/baz.cpp.exe is actually
-                # libc++.foo/bar/baz.cpp.  Matching this expectation here
-                # allows us to use the same filter string for running the tests
-                # as for building the tests.
-                test_path = suite_name[len('libc++/'):]
-                test_name = '/'.join([test_path, test_name])
-
-            filter_name = '.'.join(['libc++', test_name])
-            if not test_filter.filter(filter_name):
-                continue
-            tests.append(LibcxxTestCase(
-                suite_name, test_file, test_src_dir, build_cfg, device_dir))
+    # Walk the tree with scandir and an explicit stack, building each
+    # directory's relative path from its parent's rather than recomputing it
+    # with os.path.relpath for every file os.walk yields.
+    base_relpath = ndk.paths.to_posix_path(
+        os.path.relpath(tests_dir, out_dir_base))
+    dirs = [(tests_dir, base_relpath, '')]
+    while dirs:
+        dir_path, dir_relpath, suite_name = dirs.pop()
+        device_dir = posixpath.join(DEVICE_TEST_BASE_DIR, dir_relpath)
+        try:
+            it = os.scandir(dir_path)
+        except FileNotFoundError:
+            # libc++ may not have been built for this configuration.
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if entry.is_dir():
+                    child_suite = posixpath.join(suite_name, name)
+                    dirs.append((entry.path, posixpath.join(dir_relpath, name),
+                                 child_suite))
+                    continue
+                if not name.endswith('.exe'):
+                    continue
+
+                # Our file has a .exe extension, but the name should match the
+                # source file for the filters to work.
+                test_name = name[:-4]
+
+                # Tests in the top level don't need any mangling to match the
+                # filters.
+                if suite_name != 'libc++':
+                    if not suite_name.startswith('libc++/'):
+                        raise ValueError(suite_name)
+                    # According to the test runner, these are all part of the
+                    # "libc++" test, and the rest of the data is the subtest
+                    # name.  i.e.  libc++/foo/bar/baz.cpp.exe is actually
+                    # libc++.foo/bar/baz.cpp.  Matching this expectation here
+                    # allows us to use the same filter string for running the
+                    # tests as for building the tests.
+                    test_path = suite_name[len('libc++/'):]
+                    test_name = f'{test_path}/{test_name}'
+
+                filter_name = f'libc++.{test_name}'
+                if not test_filter.filter(filter_name):
+                    continue
+                tests.append(LibcxxTestCase(
+                    suite_name, name, test_src_dir, build_cfg, device_dir))
     return tests
 
 
@@ -342,26 +544,37 @@ def enumerate_tests(test_dir, test_src_dir, test_filter, config_filter):
         'ndk-build': enumerate_basic_tests,
     }
 
-    for build_cfg_str in os.listdir(test_dir):
-        build_cfg = ndk.test.spec.BuildConfiguration.from_string(build_cfg_str)
-        if not config_filter.filter(build_cfg):
-            continue
+    # Each configuration/test type pair scans an independent subtree, and the
+    # scans are dominated by stat and readdir calls, so run them concurrently.
+    scans = []
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for build_cfg_str in os.listdir(test_dir):
+            build_cfg = ndk.test.spec.BuildConfiguration.from_string(
+                build_cfg_str)
+            if not config_filter.filter(build_cfg):
+                continue
 
-        if build_cfg not in tests:
-            tests[build_cfg] = []
+            if build_cfg not in tests:
+                tests[build_cfg] = []
 
-        for test_type, scan_for_tests in test_subdir_class_map.items():
-            tests[build_cfg].extend(scan_for_tests(
-                test_dir, test_src_dir, build_cfg, test_type, test_filter))
+            for test_type, scan_for_tests in test_subdir_class_map.items():
+                scans.append((build_cfg, executor.submit(
+                    scan_for_tests, test_dir, test_src_dir, build_cfg,
+                    test_type, test_filter)))
+
+        for build_cfg, scan in scans:
+            tests[build_cfg].extend(scan.result())
 
     return tests
 
 
 def clear_test_directory(_worker, device):
     print('Clearing test directory on {}.'.format(device))
-    cmd = ['rm', '-r', DEVICE_TEST_BASE_DIR]
+    # Recreate the base directory in the same shell invocation so the push
+    # phase doesn't need its own mkdir round-trip per device.
+    cmd = 'rm -rf {0}; mkdir -p {0}'.format(DEVICE_TEST_BASE_DIR)
     logger().info('%s: shell_nocheck "%s"', device.name, cmd)
-    device.shell_nocheck(cmd)
+    shell_nocheck_wrap_errors(device, cmd)
 
 
 def clear_test_directories(workqueue, fleet):
@@ -373,6 +586,7 @@ def clear_test_directories(workqueue, fleet):
         workqueue.get_result()
 
 
+@functools.lru_cache(maxsize=None)
 def adb_has_feature(feature):
     cmd = ['adb', 'host-features']
     logger().info('check_output "%s"', ' '.join(cmd))
@@ -382,11 +596,197 @@ def adb_has_feature(feature):
     return feature in features
 
 
+def push_directory_as_tarball(src_dir, dest_dir, device):
+    """Pushes a directory to the device as a single tar stream.
+
+    adb push transfers each file with its own protocol round-trips, so
+    pushing the thousands of small test files is dominated by latency rather
+    than throughput. Stream one tar archive into a tar process on the device
+    instead, turning the push into a single bulk transfer.
+    """
+    # Match adb push's layout: the source directory itself is created inside
+    # dest_dir, so each configuration gets its own subdirectory rather than
+    # extracting onto its siblings.
+    target_dir = posixpath.join(dest_dir, os.path.basename(src_dir))
+    tar_cmd = ['tar', '-C', src_dir, '--mode=777', '-cf', '-', '.']
+    extract_cmd = ['adb', '-s', device.serial, 'exec-in',
+                   'mkdir -p {0} && tar -C {0} -xf -'.format(target_dir)]
+    logger().info('%s: %s | %s', device.name, ' '.join(tar_cmd),
+                  ' '.join(extract_cmd))
+    tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+    extract = subprocess.Popen(extract_cmd, stdin=tar.stdout)
+    tar.stdout.close()
+    extract.wait()
+    tar.wait()
+    if tar.returncode != 0 or extract.returncode != 0:
+        raise RuntimeError(
+            'tar push to {} failed: tar exited {}, adb exited {}'.format(
+                device.name, tar.returncode, extract.returncode))
+
+
+class AdbSyncError(RuntimeError):
+    """An adb sync-protocol request was rejected."""
+
+
+class AdbSyncClient(object):
+    """Minimal adb sync-protocol client for bulk pushes.
+
+    adb push pays protocol round-trips per file, which dominates when
+    pushing thousands of small test binaries. Speaking the sync protocol
+    directly over one socket to the adb server lets us coalesce the
+    SEND/DATA/DONE packets for many files into large writes and read the
+    acknowledgements in batches, the same trick adb's native file sync
+    client uses.
+    """
+
+    MAX_DATA = 64 * 1024
+    FLUSH_SIZE = 1024 * 1024
+    MAX_OUTSTANDING = 256
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.sock = None
+        self.buffer = bytearray()
+        self.outstanding = 0
+
+    def connect(self):
+        port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', '5037'))
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self._request('host:transport:{}'.format(self.serial))
+        self._request('sync:')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _request(self, msg):
+        data = msg.encode('utf-8')
+        self.sock.sendall('{:04x}'.format(len(data)).encode('ascii') + data)
+        status = self._recv_exact(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            length = int(self._recv_exact(4), 16)
+            raise AdbSyncError(
+                self._recv_exact(length).decode('utf-8', 'replace'))
+        raise AdbSyncError('unexpected response: {!r}'.format(status))
+
+    def _recv_exact(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise AdbSyncError('adb server closed the connection')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _flush(self, force=False):
+        if self.buffer and (force or len(self.buffer) >= self.FLUSH_SIZE):
+            self.sock.sendall(self.buffer)
+            del self.buffer[:]
+
+    def _read_acks(self):
+        # adbd sends one OKAY per DONE. Reading them in batches keeps the
+        # pipeline full without letting unread acks fill the socket buffers.
+        while self.outstanding > 0:
+            ack_id, length = struct.unpack('<4sI', self._recv_exact(8))
+            if ack_id == b'FAIL':
+                raise AdbSyncError(
+                    self._recv_exact(length).decode('utf-8', 'replace'))
+            if ack_id != b'OKAY':
+                raise AdbSyncError(
+                    'unexpected sync response: {!r}'.format(ack_id))
+            self.outstanding -= 1
+
+    def push_file(self, path, remote_path, mtime):
+        spec = '{},{}'.format(remote_path, 0o777).encode('utf-8')
+        self.buffer += struct.pack('<4sI', b'SEND', len(spec)) + spec
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.MAX_DATA)
+                if not chunk:
+                    break
+                self.buffer += struct.pack('<4sI', b'DATA', len(chunk))
+                self.buffer += chunk
+                self._flush()
+        self.buffer += struct.pack('<4sI', b'DONE', mtime)
+        self.outstanding += 1
+        if self.outstanding >= self.MAX_OUTSTANDING:
+            self._flush(force=True)
+            self._read_acks()
+        else:
+            self._flush()
+
+    def finish(self):
+        self._flush(force=True)
+        self._read_acks()
+        self.sock.sendall(struct.pack('<4sI', b'QUIT', 0))
+        self.close()
+
+
+def bulk_push(device, src_dir, dest_dir):
+    """Pushes a directory tree through one adb sync session."""
+    client = AdbSyncClient(device.serial)
+    client.connect()
+    # As with adb push and the tar path, the pushed directory lands inside
+    # dest_dir so configurations don't overwrite each other.
+    remote_base = posixpath.join(dest_dir, os.path.basename(src_dir))
+    try:
+        for root, _dirs, files in os.walk(src_dir):
+            rel_root = ndk.paths.to_posix_path(os.path.relpath(root, src_dir))
+            remote_root = posixpath.normpath(posixpath.join(remote_base,
+                                                            rel_root))
+            for name in files:
+                path = os.path.join(root, name)
+                client.push_file(path, posixpath.join(remote_root, name),
+                                 int(os.stat(path).st_mtime))
+        client.finish()
+    finally:
+        client.close()
+
+
+# Device directories already created by this worker process, keyed by
+# (serial, directory). Avoids a mkdir round-trip per pushed configuration.
+_made_device_dirs = set()
+
+
+def ensure_device_dir(device, dest_dir):
+    key = (device.serial, dest_dir)
+    if key in _made_device_dirs:
+        return
+    logger().info('%s: mkdir -p %s', device.name, dest_dir)
+    device.shell_nocheck(['mkdir', '-p', dest_dir])
+    _made_device_dirs.add(key)
+
+
 def push_tests_to_device(worker, src_dir, dest_dir, config, device,
-                         use_sync):
+                         use_sync, use_tar, dirs_prepared):
     worker.status = 'Pushing {} tests to {}.'.format(config, device)
-    logger().info('%s: mkdir %s', device.name, dest_dir)
-    device.shell_nocheck(['mkdir', dest_dir])
+    if not dirs_prepared:
+        # Otherwise --clean-device already recreated the directory for us.
+        ensure_device_dir(device, dest_dir)
+    if use_tar:
+        try:
+            push_directory_as_tarball(src_dir, dest_dir, device)
+            # tar already created everything with mode 777, so the Windows
+            # chmod fixup below is not needed.
+            return
+        except (OSError, RuntimeError) as ex:
+            # Fall back to adb push if the host has no tar or the stream
+            # failed partway.
+            logger().warning('%s: tar push failed (%s), using adb push',
+                             device.name, ex)
+    try:
+        logger().info('%s: sync push %s %s', device.name, src_dir, dest_dir)
+        bulk_push(device, src_dir, dest_dir)
+        # The sync protocol applies mode 777 from the SEND spec, so no chmod
+        # fixup is needed here either.
+        return
+    except (OSError, AdbSyncError) as ex:
+        logger().warning('%s: sync push failed (%s), using adb push',
+                         device.name, ex)
     logger().info(
         '%s: push%s %s %s', device.name, ' --sync' if use_sync else '',
         src_dir, dest_dir)
@@ -396,6 +796,9 @@ def push_tests_to_device(worker, src_dir, dest_dir, config, device,
 
 
 def finish_workqueue_with_ui(workqueue):
+    import ndk.ansi
+    import ndk.ui
+
     console = ndk.ansi.get_console()
     ui = ndk.ui.get_work_queue_ui(console, workqueue)
     with ndk.ansi.disable_terminal_echo(sys.stdin):
@@ -407,7 +810,8 @@ def finish_workqueue_with_ui(workqueue):
             ui.clear()
 
 
-def push_tests_to_devices(workqueue, test_dir, groups_for_config, use_sync):
+def push_tests_to_devices(workqueue, test_dir, groups_for_config, use_sync,
+                          use_tar, dirs_prepared):
     dest_dir = DEVICE_TEST_BASE_DIR
     for config, groups in groups_for_config.items():
         src_dir = os.path.join(test_dir, str(config))
@@ -415,7 +819,7 @@ def push_tests_to_devices(workqueue, test_dir, groups_for_config, use_sync):
             for device in group.devices:
                 workqueue.add_task(
                     push_tests_to_device, src_dir, dest_dir, config, device,
-                    use_sync)
+                    use_sync, use_tar, dirs_prepared)
 
     finish_workqueue_with_ui(workqueue)
     print('Finished pushing tests')
@@ -429,10 +833,15 @@ def disable_verity_and_wait_for_reboot(device):
     device.root()
 
     logger().info('%s: disable-verity', device.name)
-    cmd = ['adb', '-s', device.serial, 'disable-verity']
-    # disable-verity doesn't set exit status
-    _, out = ndk.ext.subprocess.call_output(cmd)
-    out = out.decode('utf-8')
+    if hasattr(device, 'disable_verity'):
+        # Going through the device wrapper reuses the already-running adb
+        # server rather than forking a fresh adb client.
+        out = device.disable_verity()
+    else:
+        cmd = ['adb', '-s', device.serial, 'disable-verity']
+        # disable-verity doesn't set exit status
+        _, out = ndk.ext.subprocess.call_output(cmd)
+        out = out.decode('utf-8')
     logger().info('%s: disable-verity:\n%s', device, out)
     if 'disabled on /' not in out:
         raise RuntimeError('{}: adb disable-verity failed:\n{}'.format(
@@ -451,6 +860,14 @@ def run_test(worker, test):
     return test.run(device)
 
 
+def delayed_run_test(worker, test, delay):
+    device = worker.data[0]
+    worker.status = 'Waiting {}s to rerun {}'.format(delay, test.name)
+    time.sleep(delay)
+    worker.status = 'Running {}'.format(test.name)
+    return test.run(device)
+
+
 def print_test_stats(test_groups):
     test_stats = {}
     for config, tests in test_groups.items():
@@ -504,7 +921,29 @@ def pair_test_runs(test_groups, groups_for_config):
     return test_runs
 
 
+def interleave_test_runs(test_runs):
+    """Round-robins test runs across device groups.
+
+    pair_test_runs produces runs ordered by (build config, device group,
+    test), so long stretches of the list all target the same device group.
+    Dealing the runs out one group at a time keeps every group busy from the
+    start and spreads the load as evenly as a shuffle, deterministically.
+    """
+    by_group = collections.defaultdict(list)
+    for test_run in test_runs:
+        by_group[test_run.device_group].append(test_run)
+
+    interleaved = []
+    for batch in itertools.zip_longest(*by_group.values()):
+        interleaved.extend(test_run for test_run in batch
+                           if test_run is not None)
+    return interleaved
+
+
 def wait_for_results(report, workqueue, printer):
+    import ndk.ansi
+    import ndk.test.ui
+
     console = ndk.ansi.get_console()
     ui = ndk.test.ui.get_test_progress_ui(console, workqueue)
     with ndk.ansi.disable_terminal_echo(sys.stdin):
@@ -547,14 +986,16 @@ def restart_flaky_tests(report, workqueue):
     if len(rerun_tests) > 0:
         cooldown = 10
         logger().warning(
-            'Found %d flaky failures. Sleeping for %d seconds to let '
+            'Found %d flaky failures. Delaying reruns by %d seconds to let '
             'devices recover.', len(rerun_tests), cooldown)
-        time.sleep(cooldown)
 
     for flaky_report in rerun_tests:
         logger().warning('Flaky test failure: %s', flaky_report.result)
         group = flaky_report.result.test.device_group
-        workqueue.add_task(group, run_test, flaky_report.result.test)
+        # Sleep in the worker rather than here so the cooldown only stalls
+        # the shard that needs to recover instead of the whole run.
+        workqueue.add_task(
+            group, delayed_run_test, flaky_report.result.test, cooldown)
 
 
 def get_config_dict(config, abis):
@@ -612,6 +1053,9 @@ def parse_args():
     run_options.add_argument(
         '--require-all-devices', action='store_true',
         help='Abort if any devices specified by the config are not available.')
+    run_options.add_argument(
+        '--no-tar-push', action='store_true',
+        help='Push tests with adb push rather than a tar stream.')
 
     display_options = parser.add_argument_group('Display Options')
     display_options.add_argument(
@@ -641,8 +1085,10 @@ def parse_args():
 
 class ConfigFilter(object):
     def __init__(self, test_config):
+        import ndk.test.builder
+
         test_spec = ndk.test.builder.test_spec_from_config(test_config)
-        self.config_abis = test_spec.abis
+        self.config_abis = frozenset(test_spec.abis)
 
     def filter(self, build_config):
         return build_config.abi in self.config_abis
@@ -650,13 +1096,25 @@ class ConfigFilter(object):
 
 class ShardingWorkQueue(object):
     def __init__(self, device_groups, procs_per_device):
-        self.manager = multiprocessing.Manager()
-        self.result_queue = self.manager.Queue()
+        # Workers only ever put and the main process only ever gets, which is
+        # all SimpleQueue supports, and it has less locking overhead than the
+        # Manager proxy or even multiprocessing.Queue's feeder thread.
+        self.result_queue = multiprocessing.SimpleQueue()
         self.task_queues = {}
         self.work_queues = []
         self.num_tasks = 0
+        # The group set is fixed for the queue's lifetime; keep a sorted view
+        # here so consumers (the progress UI renders it every frame) don't
+        # have to re-sort the keys themselves.
+        self.sorted_task_groups = sorted(device_groups)
+        # Pending tasks per group, tracked in this process. The UI can't use
+        # Queue.qsize() for this: it raises NotImplementedError on macOS.
+        self.group_pending = {group: 0 for group in device_groups}
         for group in device_groups:
-            self.task_queues[group] = self.manager.Queue()
+            # Tasks only flow from this process to the workers, so a plain
+            # multiprocessing.Queue works here and skips the Manager's proxy
+            # round-trip for every put and get.
+            self.task_queues[group] = multiprocessing.Queue()
             for device in group.devices:
                 self.work_queues.append(
                     ndk.workqueue.WorkQueue(
@@ -667,6 +1125,24 @@ class ShardingWorkQueue(object):
         self.task_queues[group].put(
             ndk.workqueue.Task(func, args, kwargs))
         self.num_tasks += 1
+        self.group_pending[group] += 1
+
+    def add_tasks(self, tasks):
+        """Enqueues a batch of (group, func, args) tasks.
+
+        Grouping the batch by device group first means each group's queue is
+        looked up once and receives its tasks back to back, rather than
+        interleaving queue handoffs across groups for thousands of tests.
+        """
+        by_group = collections.defaultdict(list)
+        for group, func, args in tasks:
+            by_group[group].append(ndk.workqueue.Task(func, args, {}))
+        for group, group_tasks in by_group.items():
+            task_queue = self.task_queues[group]
+            for task in group_tasks:
+                task_queue.put(task)
+            self.num_tasks += len(group_tasks)
+            self.group_pending[group] += len(group_tasks)
 
     def get_result(self):
         """Gets a result from the queue, blocking until one is available."""
@@ -674,6 +1150,9 @@ class ShardingWorkQueue(object):
         if isinstance(result, ndk.workqueue.TaskError):
             raise result
         self.num_tasks -= 1
+        # Every task on this queue is a test run, so the result carries the
+        # TestRun and with it the group whose count to settle.
+        self.group_pending[result.test.device_group] -= 1
         return result
 
     def terminate(self):
@@ -714,14 +1193,20 @@ class Results(object):
 
 
 def run_tests(args):
+    # Deferred so that --help and build-only invocations don't pay for
+    # importing the whole test framework (and the adb package it pulls in).
+    import ndk.test.devices
+    import ndk.test.filters
+    import ndk.test.printers
+    import ndk.test.report
+
     results = Results()
 
-    if not os.path.exists(args.test_dir):
-        if args.rebuild or args.build_only:
-            os.makedirs(args.test_dir)
-        else:
-            sys.exit('Test output directory does not exist: {}'.format(
-                args.test_dir))
+    if args.rebuild or args.build_only:
+        os.makedirs(args.test_dir, exist_ok=True)
+    elif not os.path.isdir(args.test_dir):
+        sys.exit('Test output directory does not exist: {}'.format(
+            args.test_dir))
 
     test_config = get_config_dict(args.config, args.abi)
 
@@ -825,7 +1310,8 @@ def run_tests(args):
         push_timer = ndk.timer.Timer()
         with push_timer:
             push_tests_to_devices(
-                workqueue, test_dist_dir, groups_for_config, can_use_sync)
+                workqueue, test_dist_dir, groups_for_config, can_use_sync,
+                not args.no_tar_push, args.clean_device)
         results.add_timing_report('Push', push_timer)
     finally:
         workqueue.terminate()
@@ -836,15 +1322,17 @@ def run_tests(args):
         # Need an input queue per device group, a single result queue, and a
         # pool of threads per device.
 
-        # Shuffle the test runs to distribute the load more evenly. These are
-        # ordered by (build config, device, test), so most of the tests running
-        # at any given point in time are all running on the same device.
-        test_runs = pair_test_runs(test_groups, groups_for_config)
-        random.shuffle(test_runs)
+        # Interleave the test runs across device groups to distribute the
+        # load more evenly. These are ordered by (build config, device,
+        # test), so without this most of the tests running at any given point
+        # in time would all be running on the same device.
+        test_runs = interleave_test_runs(
+            pair_test_runs(test_groups, groups_for_config))
         test_run_timer = ndk.timer.Timer()
         with test_run_timer:
-            for test_run in test_runs:
-                shard_queue.add_task(test_run.device_group, run_test, test_run)
+            shard_queue.add_tasks(
+                (test_run.device_group, run_test, (test_run,))
+                for test_run in test_runs)
 
             wait_for_results(report, shard_queue, printer)
             restart_flaky_tests(report, shard_queue)
@@ -865,6 +1353,11 @@ def run_tests(args):
 
 
 def main():
+    # Deferred since notification is only needed at the very end of a run,
+    # but it must be imported at the top: a local import anywhere in the
+    # function makes 'ndk' function-local everywhere in it.
+    import ndk.notify
+
     args = parse_args()
 
     log_levels = [logging.WARNING, logging.INFO, logging.DEBUG]
@@ -270,13 +270,16 @@ class LoadRestrictingWorkQueue(object):
     """
 
     def __init__(self, num_workers=multiprocessing.cpu_count()):
-        self.manager = multiprocessing.Manager()
-        self.result_queue = self.manager.Queue()
+        # Plain multiprocessing queues rather than Manager queues: a Manager
+        # proxies every put/get through an extra server process, and the
+        # result queue only ever has one reader, which is all SimpleQueue
+        # supports.
+        self.result_queue = multiprocessing.SimpleQueue()
 
         assert num_workers >= 2
 
-        self.main_task_queue = self.manager.Queue()
-        self.restricted_task_queue = self.manager.Queue()
+        self.main_task_queue = multiprocessing.Queue()
+        self.restricted_task_queue = multiprocessing.Queue()
 
         self.main_work_queue = ndk.workqueue.WorkQueue(
             num_workers - 1, task_queue=self.main_task_queue,
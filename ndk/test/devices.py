@@ -159,6 +159,18 @@ class DeviceShardingGroup(object):
         self.is_emulator = first_device.is_emulator
         self.is_release = first_device.is_release
         self.is_debuggable = first_device.is_debuggable
+        self._description = None
+
+    @property
+    def description(self):
+        """A short human readable description of the group.
+
+        Built lazily and cached since the UI shows it every frame.
+        """
+        if self._description is None:
+            self._description = '{} devices android-{} {}'.format(
+                len(self.devices), self.version, ', '.join(self.abis))
+        return self._description
 
     def add_device(self, device):
         if not self.device_matches(device):
@@ -166,6 +178,7 @@ class DeviceShardingGroup(object):
                 device))
 
         self.devices.append(device)
+        self._description = None
 
     def device_matches(self, device):
         if self.version != device.version:
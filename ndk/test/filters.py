@@ -14,14 +14,21 @@
 # limitations under the License.
 #
 import fnmatch
+import os.path
+import re
 
 
 class FilterFunc(object):
     def __init__(self, pattern):
         self.pattern = pattern
+        # fnmatch.fnmatch translates and recompiles the pattern on every
+        # call (modulo a small cache). Filters are matched against every
+        # discovered test, so compile the pattern once up front. Keep
+        # fnmatch's case normalization so behavior doesn't change on Windows.
+        self.regex = re.compile(fnmatch.translate(os.path.normcase(pattern)))
 
     def __call__(self, test_name):
-        return fnmatch.fnmatch(test_name, self.pattern)
+        return self.regex.match(os.path.normcase(test_name)) is not None
 
 
 class TestFilter(object):
@@ -106,6 +106,10 @@ class BuildTestScanner(TestScanner):
 
 class LibcxxTestScanner(TestScanner):
     ALL_TESTS = []
+    # Test paths keyed by their xunit-mangled form ('.' replaced with '_'),
+    # so xunit report names can be resolved with a dict hit instead of an
+    # fnmatch over every test.
+    ALL_TESTS_BY_MANGLED = {}
 
     def __init__(self, ndk_path):
         self.ndk_path = ndk_path
@@ -140,3 +144,6 @@ class LibcxxTestScanner(TestScanner):
                     test_path = ndk.paths.to_posix_path(os.path.relpath(
                         os.path.join(root, test_file), test_base_dir))
                     cls.ALL_TESTS.append(test_path)
+                    mangled = test_path.replace('.', '_')
+                    cls.ALL_TESTS_BY_MANGLED.setdefault(
+                        mangled, []).append(test_path)
@@ -13,9 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import fnmatch
 import unittest
 
-from filters import TestFilter
+from ndk.test.filters import FilterFunc, TestFilter
+
+
+class FilterFuncTest(unittest.TestCase):
+    def test_matches_like_fnmatch(self):
+        """Test that the precompiled pattern agrees with fnmatch."""
+        patterns = ['foo', 'foo*', 'foo.b*', '*.bar', 'f?o', '[fg]oo']
+        names = ['foo', 'foobar', 'foo.bar', 'foo.baz', 'fao', 'goo', 'qux']
+        for pattern in patterns:
+            func = FilterFunc(pattern)
+            for name in names:
+                self.assertEqual(
+                    fnmatch.fnmatch(name, pattern), func(name),
+                    'pattern {} name {}'.format(pattern, name))
+
+    def test_full_match_required(self):
+        """Test that the whole name must match, as with fnmatch."""
+        self.assertTrue(FilterFunc('foo*')('foobar'))
+        self.assertFalse(FilterFunc('foo')('foobar'))
+        self.assertFalse(FilterFunc('bar')('foobar'))
 
 
 class FilterTest(unittest.TestCase):
@@ -13,14 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import concurrent.futures
 import fnmatch
-import imp
+import functools
+import importlib.util
 import logging
+import mmap
 import multiprocessing
 import os
 import re
 import shutil
 import subprocess
+import threading
 import xml.etree.ElementTree
 
 import ndk.abis
@@ -39,27 +43,126 @@ def logger():
     return logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _load_test_config(test_dir):
+    """Loads a test directory's TestConfig once per process.
+
+    A test's config is consulted several times per build (broken,
+    unsupported, extra flags) and the same directory is built for every
+    (abi, api) configuration, so rereading and re-executing test_config.py
+    each time is pure overhead. Configs are treated as read-only by callers,
+    so sharing one instance is safe.
+    """
+    return ndk.test.config.TestConfig.from_test_dir(test_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_libcxx_test_config(test_dir):
+    """Loads a libc++ test directory's config once per process."""
+    return ndk.test.config.LibcxxTestConfig.from_test_dir(test_dir)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_base_env():
+    """Returns the base environment for build subprocesses.
+
+    os.environ has enough entries that copying it per build shows up; the
+    snapshot is copied once and each build only adds its few overrides. The
+    snapshot is taken on first use rather than at import so variables set
+    after import (checkbuild.py exports ANDROID_BUILD_TOP) are included.
+    """
+    return dict(os.environ)
+
+
+# The CPU count can't change while we're running, so compute the jobs
+# arguments once rather than calling cpu_count for every build.
+_CPUS = multiprocessing.cpu_count()
+_JOBS_ARGS = ['-j{}'.format(_CPUS), '-l{}'.format(_CPUS)]
+
+
 def _get_jobs_args():
-    cpus = multiprocessing.cpu_count()
-    return ['-j{}'.format(cpus), '-l{}'.format(cpus)]
+    return list(_JOBS_ARGS)
+
+
+# test.py modules that have already been executed, keyed by the identity of
+# the file on disk. Each test.py is built for many (abi, api) configurations,
+# and keying by inode means the per-configuration copies of the same file
+# share one compiled module.
+_test_py_cache = {}
+
+
+def _load_test_py(path):
+    """Loads a test.py module, reusing an already-executed module if one
+    exists for the same file."""
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    module = _test_py_cache.get(key)
+    if module is None:
+        spec = importlib.util.spec_from_file_location('test', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _test_py_cache[key] = module
+    return module
+
+
+def _clone_tree(src, dst):
+    """Recreates the src tree at dst, hardlinking files where possible.
+
+    Test sources are read-only inputs to the build, so hardlinking them into
+    the build directory turns the per-configuration copy into an inode
+    operation instead of copying every byte. Falls back to a real copy when
+    linking fails (cross-device, or a filesystem that forbids links).
+    """
+    os.makedirs(dst)
+    with os.scandir(src) as it:
+        for entry in it:
+            dst_path = os.path.join(dst, entry.name)
+            if entry.is_dir():
+                _clone_tree(entry.path, dst_path)
+                continue
+            try:
+                os.link(entry.path, dst_path)
+            except OSError:
+                shutil.copy2(entry.path, dst_path)
+
+
+def _link_or_copy(src, dst):
+    """Hardlinks src to dst, copying if the link cannot be made.
+
+    The sources are never modified in place, so a hardlink is as good as a
+    copy and skips the data transfer. Any existing dst is replaced so the
+    link doesn't fail on a leftover from an earlier run.
+    """
+    try:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
 
 
 def _prep_build_dir(src_dir, out_dir):
     if os.path.exists(out_dir):
         shutil.rmtree(out_dir)
-    shutil.copytree(src_dir, out_dir)
+    _clone_tree(src_dir, out_dir)
 
 
 def _run_build_sh_test(test, build_dir, test_dir, ndk_path, ndk_build_flags,
                        abi, platform):
     _prep_build_dir(test_dir, build_dir)
     with ndk.ext.os.cd(build_dir):
-        build_cmd = ['bash', 'build.sh'] + _get_jobs_args() + ndk_build_flags
-        test_env = dict(os.environ)
-        test_env['NDK'] = ndk_path
+        # Most build.sh files are executable; run them directly and save a
+        # bash launch. Fall back to bash for any that lost the bit.
+        if os.access('build.sh', os.X_OK):
+            build_cmd = ['./build.sh']
+        else:
+            build_cmd = ['bash', 'build.sh']
+        build_cmd += _get_jobs_args() + ndk_build_flags
+        test_env = {**_get_base_env(),
+                    'NDK': ndk_path,
+                    'APP_PLATFORM': 'android-{}'.format(platform)}
         if abi is not None:
             test_env['APP_ABI'] = abi
-        test_env['APP_PLATFORM'] = 'android-{}'.format(platform)
         rc, out = ndk.ext.subprocess.call_output(build_cmd, env=test_env)
         if rc == 0:
             return ndk.test.result.Success(test)
@@ -85,35 +188,75 @@ def _run_ndk_build_test(test, obj_dir, dist_dir, test_dir, ndk_path,
             return ndk.test.result.Failure(test, out)
 
 
-def _run_cmake_build_test(test, obj_dir, dist_dir, test_dir, ndk_path,
-                          cmake_flags, abi, platform):
-    _prep_build_dir(test_dir, obj_dir)
+_CMAKE_VERSION_RE = re.compile(r'cmake version (\d+)\.(\d+)\.')
 
-    # Add prebuilts to PATH.
-    prebuilts_host_tag = ndk.hosts.get_default_host() + '-x86'
-    prebuilts_bin = ndk.paths.android_path(
-        'prebuilts', 'cmake', prebuilts_host_tag, 'bin')
-    env_path = prebuilts_bin + os.pathsep + os.environ['PATH']
 
-    # Fail if we don't have a working cmake executable, either from the
-    # prebuilts, or from the SDK, or if a new enough version is installed.
+def _check_cmake_and_ninja(env_path):
+    """Finds working cmake and ninja executables on the given PATH.
+
+    Fail if we don't have a working cmake executable, either from the
+    prebuilts, or from the SDK, or if a new enough version is installed.
+    Also require a working ninja executable.
+
+    Returns:
+        A (cmake_bin, ninja_bin) tuple of validated executable paths.
+
+    Raises:
+        RuntimeError: No usable cmake or ninja was found.
+    """
     cmake_bin = ndk.ext.shutil.which('cmake', path=env_path)
     if cmake_bin is None:
-        return ndk.test.result.Failure(test, 'cmake executable not found')
+        raise RuntimeError('cmake executable not found')
 
     out = subprocess.check_output([cmake_bin, '--version']).decode('utf-8')
-    version_pattern = r'cmake version (\d+)\.(\d+)\.'
-    version = [int(v) for v in re.match(version_pattern, out).groups()]
+    version = [int(v) for v in _CMAKE_VERSION_RE.match(out).groups()]
     if version < [3, 6]:
-        return ndk.test.result.Failure(test, 'cmake 3.6 or above required')
+        raise RuntimeError('cmake 3.6 or above required')
 
-    # Also require a working ninja executable.
     ninja_bin = ndk.ext.shutil.which('ninja', path=env_path)
     if ninja_bin is None:
-        return ndk.test.result.Failure(test, 'ninja executable not found')
+        raise RuntimeError('ninja executable not found')
     rc, _ = ndk.ext.subprocess.call_output([ninja_bin, '--version'])
     if rc != 0:
-        return ndk.test.result.Failure(test, 'ninja --version failed')
+        raise RuntimeError('ninja --version failed')
+    return cmake_bin, ninja_bin
+
+
+# Discovery results (or the error raised) keyed by the PATH searched. The
+# --version probes fork a process each and every CMake test needs the same
+# answer, so pay for them once per process.
+_cmake_bin_cache = {}
+_cmake_bin_cache_lock = threading.Lock()
+
+
+def _discover_cmake_and_ninja(env_path):
+    with _cmake_bin_cache_lock:
+        result = _cmake_bin_cache.get(env_path)
+        if result is None:
+            try:
+                result = _check_cmake_and_ninja(env_path)
+            except RuntimeError as ex:
+                result = ex
+            _cmake_bin_cache[env_path] = result
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def _run_cmake_build_test(test, obj_dir, dist_dir, test_dir, ndk_path,
+                          cmake_flags, abi, platform):
+    _prep_build_dir(test_dir, obj_dir)
+
+    # Add prebuilts to PATH.
+    prebuilts_host_tag = ndk.hosts.get_default_host() + '-x86'
+    prebuilts_bin = ndk.paths.android_path(
+        'prebuilts', 'cmake', prebuilts_host_tag, 'bin')
+    env_path = prebuilts_bin + os.pathsep + os.environ['PATH']
+
+    try:
+        cmake_bin, ninja_bin = _discover_cmake_and_ninja(env_path)
+    except RuntimeError as ex:
+        return ndk.test.result.Failure(test, str(ex))
 
     toolchain_file = os.path.join(ndk_path, 'build', 'cmake',
                                   'android.toolchain.cmake')
@@ -148,9 +291,12 @@ class Test(object):
         self.test_dir = test_dir
         self.config = config
         self.ndk_path = ndk_path
+        # Formatted once here; get_build_dir and friends are called often
+        # enough that rebuilding the string each time shows up.
+        self._config_str = str(config)
 
     def get_test_config(self):
-        return ndk.test.config.TestConfig.from_test_dir(self.test_dir)
+        return _load_test_config(self.test_dir)
 
     def run(self, obj_dir, dist_dir, test_filters):
         raise NotImplementedError
@@ -166,6 +312,11 @@ class BuildTest(Test):
         if self.api is None:
             raise ValueError
 
+        # The flag lists are rebuilt from the test config on every property
+        # access otherwise, and they're consulted repeatedly per build.
+        self._ndk_build_flags = None
+        self._cmake_flags = None
+
     @property
     def abi(self):
         return self.config.abi
@@ -180,17 +331,21 @@ class BuildTest(Test):
 
     @property
     def ndk_build_flags(self):
-        flags = self.config.get_extra_ndk_build_flags()
-        if flags is None:
-            flags = []
-        return flags + self.get_extra_ndk_build_flags()
+        if self._ndk_build_flags is None:
+            flags = self.config.get_extra_ndk_build_flags()
+            if flags is None:
+                flags = []
+            self._ndk_build_flags = flags + self.get_extra_ndk_build_flags()
+        return self._ndk_build_flags
 
     @property
     def cmake_flags(self):
-        flags = self.config.get_extra_cmake_flags()
-        if flags is None:
-            flags = []
-        return flags + self.get_extra_cmake_flags()
+        if self._cmake_flags is None:
+            flags = self.config.get_extra_cmake_flags()
+            if flags is None:
+                flags = []
+            self._cmake_flags = flags + self.get_extra_cmake_flags()
+        return self._cmake_flags
 
     def run(self, obj_dir, dist_dir, _test_filters):
         raise NotImplementedError
@@ -246,14 +401,14 @@ class PythonBuildTest(BuildTest):
         assert self.ndk_build_flags is not None
 
     def get_build_dir(self, out_dir):
-        return os.path.join(out_dir, str(self.config), 'test.py', self.name)
+        return os.path.join(out_dir, self._config_str, 'test.py', self.name)
 
     def run(self, obj_dir, _dist_dir, _test_filters):
         build_dir = self.get_build_dir(obj_dir)
         logger().info('Building test: %s', self.name)
         _prep_build_dir(self.test_dir, build_dir)
         with ndk.ext.os.cd(build_dir):
-            module = imp.load_source('test', 'test.py')
+            module = _load_test_py('test.py')
             success, failure_message = module.run_test(
                 self.ndk_path, self.abi, self.platform, self.ndk_build_flags)
             if success:
@@ -271,7 +426,7 @@ class ShellBuildTest(BuildTest):
         super(ShellBuildTest, self).__init__(name, test_dir, config, ndk_path)
 
     def get_build_dir(self, out_dir):
-        return os.path.join(out_dir, str(self.config), 'build.sh', self.name)
+        return os.path.join(out_dir, self._config_str, 'build.sh', self.name)
 
     def run(self, obj_dir, _dist_dir, _test_filters):
         build_dir = self.get_build_dir(obj_dir)
@@ -299,17 +454,32 @@ def _platform_from_application_mk(test_dir):
         ValueError: Found an unexpected value for APP_PLATFORM.
     """
     application_mk = os.path.join(test_dir, 'jni/Application.mk')
-    if not os.path.exists(application_mk):
+    try:
+        with open(application_mk, 'rb') as application_mk_file:
+            # One mmap find beats iterating the file line by line in Python;
+            # the substring search runs in C over the whole mapping.
+            data = mmap.mmap(application_mk_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # Cannot mmap an empty file.
         return None
 
-    with open(application_mk) as application_mk_file:
-        for line in application_mk_file:
-            if line.startswith('APP_PLATFORM'):
-                _, platform_str = line.split(':=')
-                break
+    with data:
+        if data[:len(b'APP_PLATFORM')] == b'APP_PLATFORM':
+            idx = 0
         else:
-            return None
-
+            idx = data.find(b'\nAPP_PLATFORM')
+            if idx == -1:
+                return None
+            idx += 1
+        end = data.find(b'\n', idx)
+        if end == -1:
+            end = len(data)
+        line = data[idx:end].decode('utf-8')
+
+    _, platform_str = line.split(':=')
     platform_str = platform_str.strip()
     if not platform_str.startswith('android-'):
         raise ValueError(platform_str)
@@ -360,7 +530,7 @@ class NdkBuildTest(BuildTest):
             return os.path.join(self.get_build_dir(obj_dir), 'dist')
 
     def get_build_dir(self, out_dir):
-        return os.path.join(out_dir, str(self.config), 'ndk-build', self.name)
+        return os.path.join(out_dir, self._config_str, 'ndk-build', self.name)
 
     def run(self, obj_dir, dist_dir, _test_filters):
         logger().info('Building test: %s', self.name)
@@ -386,7 +556,7 @@ class CMakeBuildTest(BuildTest):
             return os.path.join(self.get_build_dir(obj_dir), 'dist')
 
     def get_build_dir(self, out_dir):
-        return os.path.join(out_dir, str(self.config), 'cmake', self.name)
+        return os.path.join(out_dir, self._config_str, 'cmake', self.name)
 
     def run(self, obj_dir, dist_dir, _test_filters):
         obj_dir = self.get_build_dir(obj_dir)
@@ -399,17 +569,23 @@ class CMakeBuildTest(BuildTest):
 
 
 def get_xunit_reports(xunit_file, test_base_dir, config, ndk_path):
-    tree = xml.etree.ElementTree.parse(xunit_file)
-    root = tree.getroot()
-    cases = root.findall('.//testcase')
+    # Stream the report with iterparse rather than loading the whole tree;
+    # libc++ xunit output can be many MB and tens of thousands of cases.
+    cases = []
+    events = xml.etree.ElementTree.iterparse(xunit_file, events=('end',))
+    for _event, elem in events:
+        if elem.tag != 'testcase':
+            continue
+        failure_texts = [node.text for node in elem.findall('failure')]
+        cases.append((elem.get('classname'), elem.get('name'), failure_texts))
+        elem.clear()
 
-    reports = []
-    for test_case in cases:
-        mangled_test_dir = test_case.get('classname')
+    def resolve(case):
+        mangled_test_dir, case_name, failure_texts = case
 
         # The classname is the path from the root of the libc++ test directory
         # to the directory containing the test (prefixed with 'libc++.')...
-        mangled_path = '/'.join([mangled_test_dir, test_case.get('name')])
+        mangled_path = '/'.join([mangled_test_dir, case_name])
 
         # ... that has had '.' in its path replaced with '_' because xunit.
         test_matches = find_original_libcxx_test(mangled_path, ndk_path)
@@ -424,24 +600,28 @@ def get_xunit_reports(xunit_file, test_base_dir, config, ndk_path):
         name = test_matches[0]
         test_dir = os.path.dirname(name)[len('libc++.'):]
 
-        failure_nodes = test_case.findall('failure')
-        if len(failure_nodes) == 0:
-            reports.append(XunitSuccess(
-                name, test_base_dir, test_dir, config, ndk_path))
-            continue
+        if len(failure_texts) == 0:
+            return XunitSuccess(
+                name, test_base_dir, test_dir, config, ndk_path)
 
-        if len(failure_nodes) != 1:
+        if len(failure_texts) != 1:
             msg = ('Could not parse XUnit output: test case does not have a '
                    'unique failure node: {}'.format(name))
             raise RuntimeError(msg)
 
-        failure_node = failure_nodes[0]
-        failure_text = failure_node.text
-        reports.append(XunitFailure(
-            name, test_base_dir, test_dir, failure_text, config, ndk_path))
-    return reports
+        return XunitFailure(
+            name, test_base_dir, test_dir, failure_texts[0], config, ndk_path)
+
+    # Populate the libc++ test index before fanning out: find_all_libcxx_tests
+    # is only safe to run from a single thread, and on Windows a fresh worker
+    # process arrives here with the cache empty.
+    ndk.test.scanner.LibcxxTestScanner.find_all_libcxx_tests(ndk_path)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return list(executor.map(resolve, cases))
 
 
+@functools.lru_cache(maxsize=None)
 def get_lit_cmd():
     # The build server doesn't install lit to a virtualenv, so use it from the
     # source location if possible.
@@ -474,19 +654,53 @@ def find_original_libcxx_test(name, ndk_path):
         raise ValueError('libc++ test name must begin with "libc++."')
 
     name = name[len(test_prefix):]
-    test_pattern = name.replace('_', '?')
-    matches = []
 
     # On Windows, a multiprocessing worker process does not inherit ALL_TESTS,
     # so we must scan libc++ tests in each worker.
     ndk.test.scanner.LibcxxTestScanner.find_all_libcxx_tests(ndk_path)
 
+    # LIT's mangling only replaces '.' with '_', so the mangled name is
+    # exactly the precomputed mangled form of the original path.
+    index = ndk.test.scanner.LibcxxTestScanner.ALL_TESTS_BY_MANGLED
+    indexed = index.get(name)
+    if indexed is not None:
+        return [test_prefix + match for match in indexed]
+
+    # Fall back to the wildcard scan; '?' matches more than just '.' and '_',
+    # so this can find matches the index cannot.
+    test_pattern = name.replace('_', '?')
+    matches = []
     all_libcxx_tests = ndk.test.scanner.LibcxxTestScanner.ALL_TESTS
     for match in fnmatch.filter(all_libcxx_tests, test_pattern):
         matches.append(test_prefix + match)
     return matches
 
 
+@functools.lru_cache(maxsize=None)
+def _enumerate_libcxx_dat_files(libcxx_test_path):
+    """Lists the .dat resource files under the libc++ test tree.
+
+    Every LibcxxTest run needs the same list and the tree holds thousands of
+    files, so walk it once per process instead of once per run.
+    """
+    dat_files = []
+    dirs = [(libcxx_test_path, '')]
+    while dirs:
+        dir_path, rel_dir = dirs.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(
+                        (entry.path, os.path.join(rel_dir, entry.name)))
+                elif entry.name.endswith('.dat'):
+                    dat_files.append((entry.path, rel_dir))
+    return dat_files
+
+
+_lit_site_cfgs_written = set()
+_lit_site_cfg_lock = threading.Lock()
+
+
 class LibcxxTest(Test):
     def __init__(self, name, test_dir, config, ndk_path):
         if config.api is None:
@@ -503,7 +717,7 @@ class LibcxxTest(Test):
         return self.config.api
 
     def get_build_dir(self, out_dir):
-        return os.path.join(out_dir, str(self.config), 'libcxx', self.name)
+        return os.path.join(out_dir, self._config_str, 'libcxx', self.name)
 
     def run_lit(self, build_dir, filters):
         libcxx_dir = os.path.join(self.ndk_path, 'sources/cxx-stl/llvm-libc++')
@@ -528,8 +742,15 @@ class LibcxxTest(Test):
         for key, value in replacements:
             lit_cfg_args.append('--param={}={}'.format(key, value))
 
-        shutil.copy2(os.path.join(libcxx_dir, 'test/lit.ndk.cfg.in'),
-                     os.path.join(libcxx_dir, 'test/lit.site.cfg'))
+        # The site config is the same for every configuration, so only write
+        # it once per process. This also keeps concurrent LibcxxTest runs
+        # from rewriting the file under a lit invocation that is reading it.
+        site_cfg = os.path.join(libcxx_dir, 'test/lit.site.cfg')
+        with _lit_site_cfg_lock:
+            if site_cfg not in _lit_site_cfgs_written:
+                shutil.copy2(
+                    os.path.join(libcxx_dir, 'test/lit.ndk.cfg.in'), site_cfg)
+                _lit_site_cfgs_written.add(site_cfg)
 
         xunit_output = os.path.join(build_dir, 'xunit.xml')
 
@@ -562,8 +783,7 @@ class LibcxxTest(Test):
             if logger().isEnabledFor(logging.INFO):
                 stdout = None
                 stderr = None
-            env = dict(os.environ)
-            env['NDK'] = self.ndk_path
+            env = {**_get_base_env(), 'NDK': self.ndk_path}
             subprocess.call(lit_args, env=env, stdout=stdout, stderr=stderr)
 
     def run(self, obj_dir, dist_dir, test_filters):
@@ -581,7 +801,8 @@ class LibcxxTest(Test):
         libcxx_so_path = os.path.join(
             libcxx_path, 'libs', self.config.abi, 'libc++_shared.so')
         libcxx_test_path = os.path.join(libcxx_path, 'test')
-        shutil.copy2(libcxx_so_path, build_dir)
+        _link_or_copy(libcxx_so_path,
+                      os.path.join(build_dir, 'libc++_shared.so'))
 
         # The libc++ test runner's filters are path based. Assemble the path to
         # the test based on the late_filters (early filters for a libc++ test
@@ -608,16 +829,12 @@ class LibcxxTest(Test):
             filters.append(path)
         self.run_lit(build_dir, filters)
 
-        for root, _, files in os.walk(libcxx_test_path):
-            for test_file in files:
-                if not test_file.endswith('.dat'):
-                    continue
-                test_relpath = os.path.relpath(root, libcxx_test_path)
-                dest_dir = os.path.join(build_dir, test_relpath)
-                if not os.path.exists(dest_dir):
-                    continue
+        for src, test_relpath in _enumerate_libcxx_dat_files(libcxx_test_path):
+            dest_dir = os.path.join(build_dir, test_relpath)
+            if not os.path.exists(dest_dir):
+                continue
 
-                shutil.copy2(os.path.join(root, test_file), dest_dir)
+            _link_or_copy(src, os.path.join(dest_dir, os.path.basename(src)))
 
         # We create a bunch of fake tests that report the status of each
         # individual test in the xunit report.
@@ -660,7 +877,7 @@ class XunitResult(Test):
 
     def get_test_config(self):
         test_config_dir = os.path.join(self.test_base_dir, self.test_dir)
-        return ndk.test.config.LibcxxTestConfig.from_test_dir(test_config_dir)
+        return _load_libcxx_test_config(test_config_dir)
 
     def check_broken(self):
         name = os.path.splitext(os.path.basename(self.name))[0]
@@ -49,26 +49,53 @@ class TestProgressUi(ndk.ui.Ui):
         self.show_device_groups = show_device_groups
         self.workqueue = workqueue
 
+        # The device groups don't change once the workqueue is built, so use
+        # its sorted view rather than re-sorting every frame. The group
+        # descriptions are cached on the groups themselves.
+        self.sorted_groups = self.workqueue.sorted_task_groups
+        # Fingerprint of the last frame's inputs so identical frames can
+        # return the previous lines without reformatting anything.
+        self.last_frame_key = None
+        self.last_frame_lines = None
+
     def get_ui_lines(self):
-        lines = []
+        workqueue = self.workqueue
 
+        statuses = ()
         if self.show_worker_status:
-            for work_queue in self.workqueue.work_queues:
-                for worker in work_queue.workers:
-                    lines.append(worker.status)
+            statuses = tuple(worker.status
+                             for work_queue in workqueue.work_queues
+                             for worker in work_queue.workers)
+
+        qsizes = ()
+        if self.show_device_groups:
+            # Parent-side counts rather than Queue.qsize(), which raises
+            # NotImplementedError on macOS.
+            group_pending = workqueue.group_pending
+            qsizes = tuple(group_pending[group]
+                           for group in self.sorted_groups)
 
-        lines.append('{: >{width}} tests remaining'.format(
-            self.workqueue.num_tasks, width=self.NUM_TESTS_DIGITS))
+        # The fingerprint is just tuples of ints and already-built status
+        # strings; if nothing changed, skip the formatting work entirely.
+        key = (workqueue.num_tasks, statuses, qsizes)
+        if key == self.last_frame_key:
+            return self.last_frame_lines
+
+        lines = list(statuses)
+
+        # str.rjust is a straight C call; the equivalent '{: >{width}}'
+        # format spec goes through the format mini-language parser per frame.
+        lines.append(str(workqueue.num_tasks).rjust(
+            self.NUM_TESTS_DIGITS) + ' tests remaining')
 
         if self.show_device_groups:
-            for group in sorted(self.workqueue.task_queues.keys()):
-                group_id = '{} devices android-{} {}'.format(
-                    len(group.devices), group.devices[0].version,
-                    ', '.join(group.abis))
-                lines.append('{: >{width}} {}'.format(
-                    self.workqueue.task_queues[group].qsize(), group_id,
-                    width=self.NUM_TESTS_DIGITS))
+            lines.extend(
+                str(qsize).rjust(self.NUM_TESTS_DIGITS) + ' ' +
+                group.description
+                for group, qsize in zip(self.sorted_groups, qsizes))
 
+        self.last_frame_key = key
+        self.last_frame_lines = lines
         return lines
 
 
@@ -90,23 +117,38 @@ class TestBuildProgressUi(ndk.ui.Ui):
         super(TestBuildProgressUi, self).__init__(ui_renderer)
         self.show_worker_status = show_worker_status
         self.workqueue = workqueue
+        # Cache of the last columnate input and output. Worker statuses
+        # usually don't all change between frames, so re-laying out the grid
+        # every render is wasted work. The renderer already diffs lines, so
+        # handing back the identical cached strings also makes its
+        # comparisons cheap.
+        self.last_columnate_key = None
+        self.last_columnated = None
 
     def get_ui_lines(self):
+        workqueue = self.workqueue
+        console = self.ui_renderer.console
         lines = []
 
         if self.show_worker_status:
-            for worker in self.workqueue.main_work_queue.workers:
-                lines.append(worker.status)
-            for worker in self.workqueue.restricted_work_queue.workers:
-                lines.append(worker.status)
-
-        if self.ui_renderer.console.smart_console:
+            lines.extend(
+                worker.status
+                for worker in workqueue.main_work_queue.workers)
+            lines.extend(
+                worker.status
+                for worker in workqueue.restricted_work_queue.workers)
+
+        if console.smart_console:
             # Keep some space at the top of the UI so we can see messages.
-            ui_height = self.ui_renderer.console.height - 10
+            ui_height = console.height - 10
             if ui_height > 0:
-                lines = ndk.ui.columnate(lines, self.ui_renderer.console.width,
-                                         ui_height)
-
-        lines.append('{: >{width}} tests remaining'.format(
-            self.workqueue.num_tasks, width=self.NUM_TESTS_DIGITS))
+                key = (lines, console.width, ui_height)
+                if key != self.last_columnate_key:
+                    self.last_columnate_key = key
+                    self.last_columnated = ndk.ui.columnate(
+                        lines, console.width, ui_height)
+                lines = list(self.last_columnated)
+
+        lines.append(str(self.workqueue.num_tasks).rjust(
+            self.NUM_TESTS_DIGITS) + ' tests remaining')
         return lines
@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 """Test for ndk.graph."""
+import sys
 import unittest
 
 import ndk.graph
@@ -75,3 +76,16 @@ class GraphTest(unittest.TestCase):
     def test_no_cycle(self):
         """Test that None is returned when there is no cycle."""
         self.assertIsNone(cycle_test(['ABCD', 'CEF']))
+
+    def test_deep_chain(self):
+        """Test that chains deeper than the recursion limit can be searched."""
+        depth = sys.getrecursionlimit() * 2
+        # Zero padded so the sorted node order matches the chain order.
+        chain = ['{:06}'.format(i) for i in range(depth)]
+        self.assertIsNone(cycle_test([chain]))
+
+    def test_deep_cycle(self):
+        """Test that a cycle is found at the bottom of a deep chain."""
+        depth = sys.getrecursionlimit() * 2
+        chain = ['{:06}'.format(i) for i in range(depth)]
+        self.cycle_test([chain + [chain[0]]], chain + [chain[0]])
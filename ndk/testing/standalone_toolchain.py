@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import functools
 import logging
 import os
 import shutil
@@ -27,11 +28,40 @@ def logger():
 
 
 def call_output(cmd, *args, **kwargs):
-    logger().info('COMMAND: ' + ' '.join(cmd))
+    if logger().isEnabledFor(logging.INFO):
+        logger().info('COMMAND: %s', ' '.join(cmd))
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT, *args, **kwargs)
-    out, _ = proc.communicate()
-    return proc.returncode, out
+    # Only one stream to drain, so communicate()'s thread machinery isn't
+    # needed; read the pipe in large chunks into a single buffer.
+    buf = bytearray()
+    read = proc.stdout.read
+    while True:
+        chunk = read(65536)
+        if not chunk:
+            break
+        buf += chunk
+    proc.stdout.close()
+    proc.wait()
+    return proc.returncode, bytes(buf)
+
+
+@functools.lru_cache(maxsize=None)
+def _windows_python(ndk_path):
+    """Returns the path to the NDK's prebuilt Python for Windows.
+
+    The directory layout probing only depends on the NDK install, so cache
+    the result rather than re-statting the prebuilt directories for every
+    toolchain we make.
+    """
+    prebuilt_dir = os.path.join(ndk_path, 'prebuilt/windows-x86_64')
+    if not os.path.exists(prebuilt_dir):
+        prebuilt_dir = os.path.join(ndk_path, 'prebuilt/windows')
+    if not os.path.exists(prebuilt_dir):
+        raise RuntimeError('Could not find prebuilts in {}'.format(
+            os.path.join(ndk_path, 'prebuilt')))
+
+    return os.path.join(prebuilt_dir, 'bin/python.exe')
 
 
 def make_standalone_toolchain(ndk_path, arch, api, extra_args, install_dir):
@@ -46,15 +76,7 @@ def make_standalone_toolchain(ndk_path, arch, api, extra_args, install_dir):
         # Windows doesn't process shebang lines, and we wouldn't be pointing at
         # the right Python if it did. Explicitly invoke the NDK's Python for on
         # Windows.
-        prebuilt_dir = os.path.join(ndk_path, 'prebuilt/windows-x86_64')
-        if not os.path.exists(prebuilt_dir):
-            prebuilt_dir = os.path.join(ndk_path, 'prebuilt/windows')
-        if not os.path.exists(prebuilt_dir):
-            raise RuntimeError('Could not find prebuilts in {}'.format(
-                os.path.join(ndk_path, 'prebuilt')))
-
-        python_path = os.path.join(prebuilt_dir, 'bin/python.exe')
-        cmd = [python_path] + cmd
+        cmd = [_windows_python(ndk_path)] + cmd
 
     rc, out = call_output(cmd)
     return rc == 0, out
@@ -74,6 +96,21 @@ def test_standalone_toolchain(install_dir, test_source, flags):
     return rc == 0, out
 
 
+def remove_tree_async(path):
+    """Removes a throwaway directory without waiting for the deletion.
+
+    A standalone toolchain is thousands of files, and rmtree unlinks them one
+    syscall at a time while the test blocks. The contents are of no further
+    interest, so on POSIX hand the job to rm and return immediately.
+    """
+    if os.name == 'posix':
+        subprocess.Popen(['rm', '-rf', path],
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 def run_test(ndk_path, abi, api, test_source, extra_args, flags):
     arch = ndk.abis.abi_to_arch(abi)
 
@@ -85,4 +122,4 @@ def run_test(ndk_path, abi, api, test_source, extra_args, flags):
             return success, out
         return test_standalone_toolchain(install_dir, test_source, flags)
     finally:
-        shutil.rmtree(install_dir)
+        remove_tree_async(install_dir)
@@ -200,20 +200,28 @@ class WorkQueueUi(Ui):
         super(WorkQueueUi, self).__init__(ui_renderer)
         self.show_worker_status = show_worker_status
         self.workqueue = workqueue
+        # Cache of the last columnate input and output so an unchanged set
+        # of worker statuses doesn't pay for a re-layout every frame.
+        self.last_columnate_key = None
+        self.last_columnated = None
 
     def get_ui_lines(self):
+        console = self.ui_renderer.console
         lines = []
 
         if self.show_worker_status:
-            for worker in self.workqueue.workers:
-                lines.append(worker.status)
+            lines.extend(worker.status for worker in self.workqueue.workers)
 
-        if self.ui_renderer.console.smart_console:
+        if console.smart_console:
             # Keep some space at the top of the UI so we can see messages.
-            ui_height = self.ui_renderer.console.height - 10
+            ui_height = console.height - 10
             if ui_height > 0:
-                lines = columnate(lines, self.ui_renderer.console.width,
-                                  ui_height)
+                key = (lines, console.width, ui_height)
+                if key != self.last_columnate_key:
+                    self.last_columnate_key = key
+                    self.last_columnated = columnate(
+                        lines, console.width, ui_height)
+                lines = list(self.last_columnated)
 
         lines.append('{: >{width}} jobs remaining'.format(
             self.workqueue.num_tasks, width=self.NUM_TESTS_DIGITS))